@@ -28,4 +28,5 @@
 __version__ = '$Revision: 4 $'
 
 __all__ = ['debugging',
+           'microbench',
            'microhttpd']
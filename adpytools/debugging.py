@@ -48,6 +48,21 @@ DebugUnset([word])
         If called with a word, it makes all subsequent calls to Debug with
         that word return False
         
+DebugFlag([word])
+
+        Returns a flag object for 'word' whose 'on' attribute is always
+        what Debug(word) would return. DebugSet and DebugUnset update
+        the flag in place, so code that checks the same word over and
+        over can look it up once and then test a plain attribute:
+
+                HTTP = DebugFlag("http")
+                ...
+                if HTTP.on:
+                        print headers
+
+        The flag also works directly as a boolean (if HTTP: ...), but
+        that goes through a method call, so .on is the fast way.
+
 DebugMessage(message, [level])
 
         message is a string
@@ -55,6 +70,29 @@ DebugMessage(message, [level])
 
         Prints the message to stderr, along with date, time, level, and
         source file name and line number where the call was made.
+
+DebugMessageSetup([background], [queue_size], [policy], [batch],
+                  [logfile], [max_bytes], [backups], [stderr])
+
+        Moves the formatting and writing done by DebugMessage off the
+        calling thread. With background=True, DebugMessage just notes
+        the caller's file and line and puts the message on a queue of
+        at most queue_size entries; a writer thread takes them off in
+        batches of up to 'batch' messages and writes each batch with a
+        single write and flush.
+
+        policy says what happens when the queue is full: "drop" throws
+        the message away (and the writer later reports how many were
+        lost), "block" makes the caller wait for room.
+
+        Messages go to stderr (unless stderr=False) and, if logfile is
+        given, to that file, which is rotated when it reaches max_bytes
+        with 'backups' old copies kept. These four only apply to the
+        writer thread; giving any of them without background=True
+        raises ValueError rather than being quietly ignored.
+
+        DebugMessageSetup() with no arguments goes back to writing
+        synchronously.
 """
 
 # ------------------------------------------------------------------------
@@ -84,11 +122,20 @@ DebugMessage(message, [level])
 # 
 # ------------------------------------------------------------------------
 
+import atexit
 import inspect
 import logging
+import logging.handlers
 import os
 import os.path
 import sys
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 ## Set up the Debug part of this code...
 
@@ -111,6 +158,38 @@ if __debug:
         pass
 
 
+class Flag(object):
+    """What DebugFlag returns; see the top of this file."""
+    __slots__ = ('name', 'on')
+
+    def __init__(self, name, on):
+        self.name = name
+        self.on = on
+
+    def __bool__(self):
+        return self.on
+
+    __nonzero__ = __bool__
+
+    def __repr__(self):
+        return 'DebugFlag(%r) -> %r' % (self.name, self.on)
+
+
+__flags = {}
+
+
+def DebugFlag(name=" "):
+    """
+    Returns the flag object for name. It's the same object every time,
+    and its 'on' attribute follows DebugSet/DebugUnset.
+    """
+    global __flags
+    try:
+        return __flags[name]
+    except KeyError:
+        return __flags.setdefault(name, Flag(name, name in __vars))
+
+
 def Debug(name=" "):
     """
     Checks to see if the "DEBUG" environment variable is set, if
@@ -130,9 +209,12 @@ def DebugSet(name=" "):
 
     global __vars
     global __debug
+    global __flags
 
     __debug = True
     __vars[name] = name
+    if name in __flags:
+        __flags[name].on = True
     return (True)
 
 
@@ -144,10 +226,13 @@ def DebugUnset(name=" "):
     """
     global __vars
     global __debug
+    global __flags
 
     if name == " ":
         __debug = False
         __vars = {}
+        for flag in __flags.values():
+            flag.on = False
         return
 
     try:
@@ -156,6 +241,9 @@ def DebugUnset(name=" "):
     except KeyError:
         pass
 
+    if name in __flags:
+        __flags[name].on = False
+
     return
 
     ## Set up the DebugMessage part of this. We use the logging module,
@@ -176,6 +264,22 @@ levels = {
 }
 
 
+def _caller(depth):
+    """
+    File name and line number of the code 'depth' frames up from the
+    caller of this function. Only hops up the frame chain; unlike
+    inspect.getouterframes it doesn't read any source files.
+    """
+    try:
+        frame = sys._getframe(depth + 1)
+    except AttributeError:
+        frame = inspect.getouterframes(inspect.currentframe())[depth + 1][0]
+    try:
+        return (os.path.basename(frame.f_code.co_filename), frame.f_lineno)
+    finally:
+        del frame
+
+
 def DebugMessage(msg, level="DEBUG"):
     """
     Produces nicely formatted output to stderr.
@@ -186,20 +290,146 @@ def DebugMessage(msg, level="DEBUG"):
       "CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG"
     """
 
-    current = inspect.currentframe()
-    outer = inspect.getouterframes(current)
-
-    try:
-        levels[level]('%s - %4d: %s' % (os.path.basename(outer[1][1]),
-                                        outer[1][2], msg))
+    filename, lineno = _caller(1)
 
-    except KeyError:
+    if level not in levels:
         DebugMessage('DebugMessage() called with unknown level: %s' % level)
-        logging.error('%s - %4d: %s' % (os.path.basename(outer[1][1]),
-                                        outer[1][2], msg))
-    del outer
-    del current
+        level = "ERROR"
+
+    if _writer is not None:
+        _writer.put(level, '%s - %4d: %s' % (filename, lineno, msg))
+    else:
+        levels[level]('%s - %4d: %s' % (filename, lineno, msg))
+
+
+class _BackgroundWriter(threading.Thread):
+    """The thread behind DebugMessageSetup(background=True)."""
+
+    def __init__(self, queue_size, policy, batch, handlers):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.messages = queue.Queue(queue_size)
+        self.block = policy == "block"
+        self.batch = batch
+        self.handlers = handlers
+        self.dropped = 0
+
+    def put(self, level, msg):
+        try:
+            self.messages.put((level, msg), self.block)
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        while True:
+            lines = []
+            item = self.messages.get()
+            while item is not None:
+                lines.append('%-8s %s' % item)
+                if len(lines) >= self.batch:
+                    break
+                try:
+                    item = self.messages.get_nowait()
+                except queue.Empty:
+                    break
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                lines.append('%-8s %d messages dropped, queue was full'
+                             % ("WARNING", dropped))
+            if lines:
+                self.write('\n'.join(lines))
+            if item is None:
+                return
+
+    def write(self, text):
+        # One record per batch, so each handler writes (and, for the
+        # rotating file, checks its size) once per batch.
+        record = logging.LogRecord('debugging', logging.INFO, __file__, 0,
+                                   text, None, None)
+        for handler in self.handlers:
+            handler.handle(record)
+
+    def stop(self, timeout=5.0):
+        self.messages.put(None)
+        self.join(timeout)
+
+
+_writer = None
+
+
+def DebugMessageSetup(background=False, queue_size=10000, policy="drop",
+                      batch=256, logfile=None, max_bytes=0, backups=0,
+                      stderr=True):
+    """
+    Sets up how DebugMessage writes its output. See the top of this
+    file for what the arguments do.
+    """
+    global _writer
+
+    if policy not in ("drop", "block"):
+        raise ValueError('unknown policy: %r' % policy)
+    if not background and (logfile or max_bytes or backups or not stderr):
+        raise ValueError('logfile, max_bytes, backups and stderr '
+                         'need background=True')
+
+    if _writer is not None:
+        _writer.stop()
+        _writer = None
+
+    if not background:
+        return
+
+    handlers = []
+    if stderr:
+        handlers.append(logging.StreamHandler(sys.stderr))
+    if logfile:
+        handlers.append(logging.handlers.RotatingFileHandler(
+            logfile, maxBytes=max_bytes, backupCount=backups))
+    for handler in handlers:
+        handler.setFormatter(logging.Formatter('%(message)s'))
+
+    _writer = _BackgroundWriter(queue_size, policy, batch, handlers)
+    _writer.start()
+
+
+def _flush_at_exit():
+    if _writer is not None:
+        _writer.stop()
+
+atexit.register(_flush_at_exit)
 
 
 __version__ = '$Id: debugging.py 4 2007-05-09 13:50:41Z adoyle $'
 if Debug('version'): print(__version__)
+
+
+if __name__ == '__main__':
+    # Compares what a check costs with Debug() and with a DebugFlag,
+    # for a word that is set and one that isn't:
+    #
+    #   python debugging.py [iterations]
+
+    import timeit
+
+    number = 1000000
+    if len(sys.argv) > 1:
+        number = int(sys.argv[1])
+
+    DebugSet("on")
+    DebugUnset("off")
+
+    setup = 'from __main__ import Debug, DebugFlag\n' \
+            'ON = DebugFlag("on")\n' \
+            'OFF = DebugFlag("off")\n'
+    checks = [('Debug("on")', 'if Debug("on"): pass'),
+              ('Debug("off")', 'if Debug("off"): pass'),
+              ('ON.on', 'if ON.on: pass'),
+              ('OFF.on', 'if OFF.on: pass'),
+              ('bool(ON)', 'if ON: pass'),
+              ('bool(OFF)', 'if OFF: pass'),
+              ('(empty loop)', 'pass')]
+
+    print('%-14s %10s' % ('check', 'ns/check'))
+    for label, stmt in checks:
+        best = min(timeit.repeat(stmt, setup, repeat=5, number=number))
+        print('%-14s %10.1f' % (label, best / number * 1e9))
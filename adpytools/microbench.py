@@ -0,0 +1,644 @@
+#!/usr/bin/env python
+
+# ------------------------------------------------------------------------
+#
+# Copyright (c) 2007 Allan Doyle
+#
+#  Permission is hereby granted, free of charge, to any person
+#  obtaining a copy of this software and associated documentation
+#  files (the "Software"), to deal in the Software without
+#  restriction, including without limitation the rights to use, copy,
+#  modify, merge, publish, distribute, sublicense, and/or sell copies
+#  of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be
+#  included in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+#  EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#  MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#  NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+#  HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+#  WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+#
+# ------------------------------------------------------------------------
+"""microbench.py
+
+Load generator and benchmarks for microhttpd.
+
+Starts a microhttpd.Server in a child process on a loopback port, with
+'bindings' URLs bound, each 'depth' segments deep, then hammers it from
+'concurrency' client threads and reports requests per second and
+latency percentiles. The results come out as JSON so that runs before
+and after a change can be compared.
+
+Scenarios:
+
+  routing    no HTTP at all, just Dispatch.lookup() on the bound URLs,
+             with and without the route cache
+  keepalive  small GETs, each client thread on one persistent connection
+  newconn    small GETs, a new connection for every request
+  large      GETs of a 'body_size' byte response
+  upload     PUTs of a 'body_size' byte request body to a stream=True
+             binding that reads it in pieces
+  writes     no network, one server thread answering a connection's
+             worth of pipelined GETs (small, and 'body_size' large)
+             through a socket that counts the send() and recv() calls
+             made on it, with the response coalescing (see
+             MyHTTPRequestHandler.coalesce) off and on
+  batch      the keepalive GETs, 'batch' at a time in POSTs to a batch
+             binding (requests and rps count the GETs, latency is per
+             POST)
+  results    no network, the same small answer returned as a dict, a
+             Response and a frozen Response, answered as in writes;
+             reports the bytes each kind of result takes per request,
+             and with tracemalloc the peak memory traced while serving
+  rebind     the keepalive GETs while another client keeps hitting a
+             binding that unbinds 'bindings' other URLs with
+             unbind_many() and binds them again with bind_many(); none
+             of the GETs should fail. Then, with no HTTP, threads look
+             up URLs through the route cache while another binds and
+             unbinds a deeper route over them; every route found has
+             to be one of the two, and the one that was bound if the
+             lookup didn't overlap a change ('wrong_routes' and
+             'stale_routes', both should be 0)
+
+Example:
+
+  python microbench.py --mode thread --concurrency 16 --requests 20000 \\
+      --bindings 1000 --depth 5 --output before.json
+
+"""
+
+import httplib
+import json
+import os
+import random
+import signal
+import socket
+import sys
+import threading
+import time
+
+import microhttpd
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2 only has it when patched for pytracemalloc
+    tracemalloc = None
+
+__version__ = '$Id$'
+
+scenarios = ['routing', 'writes', 'results', 'keepalive', 'newconn', 'large', 'upload',
+             'batch', 'rebind']
+
+
+def paths(bindings, depth):
+    """The URLs that make_server() binds."""
+    return ['/b%d' % i + ''.join(['/s%d' % d for d in range(1, depth)])
+            for i in range(bindings)]
+
+
+def small(type, match, ext, rest, note):
+    return {'h': [('Content-type', 'text/plain')], 'r': 'ok\n'}
+
+
+def small_response(type, match, ext, rest, note):
+    return microhttpd.Response('ok\n', [('Content-type', 'text/plain')])
+
+
+SMALL = microhttpd.Response('ok\n', [('Content-type', 'text/plain')],
+                            frozen=True)
+
+
+def large(type, match, ext, rest, note):
+    return {'h': [('Content-type', 'application/octet-stream')], 'r': note}
+
+
+def upload(type, match, ext, rest, note):
+    size = 0
+    for piece in rest:
+        size += len(piece)
+    return {'h': [('Content-type', 'text/plain')], 'r': '%d\n' % size}
+
+
+def rebind(type, match, ext, rest, note):
+    dispatch, urls = note
+    dispatch.unbind_many(urls)
+    dispatch.bind_many([(url, small) for url in urls])
+    return {'h': [('Content-type', 'text/plain')], 'r': 'ok\n'}
+
+
+def make_server(port, bindings=100, depth=3, body_size=1048576,
+                mode='thread', workers=8, lean=False):
+    server = microhttpd.Server()
+    server.ip_and_port('127.0.0.1', port)
+    server.concurrency(mode, workers=workers)
+    server.lean_parser(lean)
+    server.keep_alive(max_requests=0)
+    server.dispatch.bind_many([(path, small)
+                               for path in paths(bindings, depth)])
+    server.dispatch.bind('/large', large, 'x' * body_size)
+    server.dispatch.bind('/upload', upload, stream=True)
+    server.dispatch.bind('/response', small_response)
+    server.dispatch.bind('/frozen', microhttpd.constant, SMALL)
+    server.batch('/batch', workers=workers, max_requests=1000)
+    churn = ['/churn%d' % i + ''.join(['/s%d' % d for d in range(1, depth)])
+             for i in range(bindings)]
+    server.dispatch.bind('/rebind', rebind, (server.dispatch, churn))
+    return server
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def start_server(**options):
+    """
+    Forks a child serving make_server(**options) and waits until it's
+    accepting connections. Returns (pid, port).
+    """
+    port = free_port()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            # the per-request stderr lines would swamp everything else
+            sys.stdout = sys.stderr = open(os.devnull, 'w')
+            make_server(port, **options).serve_forever()
+        finally:
+            os._exit(0)
+
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return (pid, port)
+        except socket.error:
+            time.sleep(0.05)
+    stop_server(pid)
+    raise RuntimeError('server did not start on port %d' % port)
+
+
+def stop_server(pid):
+    try:
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+    except OSError:
+        pass
+
+
+def percentile(latencies, q):
+    if not latencies:
+        return None
+    return latencies[min(int(q * len(latencies)), len(latencies) - 1)]
+
+
+def summary(latencies, errors, seconds):
+    latencies.sort()
+    n = len(latencies)
+    return {'requests': n,
+            'errors': errors,
+            'seconds': round(seconds, 3),
+            'rps': round(n / seconds, 1) if seconds else None,
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 3) if n else None,
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 3) if n else None,
+            'p999_ms': round(percentile(latencies, 0.999) * 1000, 3) if n else None}
+
+
+def drive(port, requests, concurrency, method='GET', urls=('/',), body=None,
+          keepalive=True):
+    """
+    Sends 'requests' requests from 'concurrency' threads, each thread
+    going through urls round robin, and returns the summary().
+    """
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    per_thread = [requests // concurrency] * concurrency
+    for i in range(requests % concurrency):
+        per_thread[i] += 1
+
+    def client(count, offset):
+        mine = []
+        failed = 0
+        conn = None
+        headers = {}
+        if not keepalive:
+            headers['Connection'] = 'close'
+        for i in range(count):
+            url = urls[(offset + i) % len(urls)]
+            start = time.time()
+            try:
+                if conn is None:
+                    conn = httplib.HTTPConnection('127.0.0.1', port, timeout=30)
+                conn.request(method, url, body, headers)
+                response = conn.getresponse()
+                response.read()
+                if response.status >= 400:
+                    failed += 1
+                if not keepalive or response.will_close:
+                    conn.close()
+                    conn = None
+            except (socket.error, httplib.HTTPException):
+                failed += 1
+                if conn is not None:
+                    conn.close()
+                conn = None
+                continue
+            mine.append(time.time() - start)
+        if conn is not None:
+            conn.close()
+        with lock:
+            latencies.extend(mine)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=client,
+                                args=(per_thread[i], i * 7919))
+               for i in range(concurrency)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return summary(latencies, errors[0], time.time() - start)
+
+
+def rebinding(port, done):
+    """
+    GETs /rebind over and over until done is set. Returns a dict that
+    counts the rebinds and failures, filled in by the time the thread
+    returned alongside it has finished.
+    """
+    counts = {'rebinds': 0, 'rebind_errors': 0}
+
+    def client():
+        conn = None
+        while not done.isSet():
+            try:
+                if conn is None:
+                    conn = httplib.HTTPConnection('127.0.0.1', port, timeout=30)
+                conn.request('GET', '/rebind')
+                response = conn.getresponse()
+                response.read()
+                if response.status == 200:
+                    counts['rebinds'] += 1
+                else:
+                    counts['rebind_errors'] += 1
+            except (socket.error, httplib.HTTPException):
+                counts['rebind_errors'] += 1
+                if conn is not None:
+                    conn.close()
+                conn = None
+        if conn is not None:
+            conn.close()
+
+    t = threading.Thread(target=client)
+    t.start()
+    return t, counts
+
+
+def check_routes(requests, bindings, depth, readers=4):
+    """
+    Looks up p + '/deep/x' for each bound p from readers threads, with
+    a threadsafe route cache, while p + '/deep' is bound and unbound
+    over and over, pausing in between.
+
+    The writer bumps a counter before and after each change, so it's
+    odd while one is going on. A lookup that started and finished with
+    the same even count didn't overlap a change, and must have found
+    what's bound for that count; if it didn't, the cache was holding a
+    stale route. Anything other than the two routes is just wrong.
+    """
+    server = make_server(0, bindings, depth)
+    dispatch = server.dispatch
+    dispatch.route_cache(1024, threadsafe=True)
+    shallow = paths(bindings, depth)
+    deep = [p + '/deep' for p in shallow]
+    urls = [p + '/x' for p in deep]
+    counts = {'lookups': 0, 'rebinds': 0, 'wrong_routes': 0,
+              'stale_routes': 0}
+    lock = threading.Lock()
+    done = threading.Event()
+    state = [0]
+
+    def reader(offset):
+        wrong = stale = 0
+        for i in xrange(requests // readers):
+            j = (offset + i) % len(urls)
+            before = state[0]
+            found = dispatch.lookup(urls[j])
+            after = state[0]
+            if found is None or found[0] not in (shallow[j], deep[j]):
+                wrong += 1
+            elif before == after and not before % 2:
+                # even counts alternate: 0 unbound, 2 bound, 4 unbound...
+                if found[0] != (before % 4 and deep[j] or shallow[j]):
+                    stale += 1
+        with lock:
+            counts['lookups'] += requests // readers
+            counts['wrong_routes'] += wrong
+            counts['stale_routes'] += stale
+
+    def writer():
+        while not done.isSet():
+            for change in (lambda: dispatch.bind_many(
+                               [(url, small) for url in deep]),
+                           lambda: dispatch.unbind_many(deep)):
+                state[0] += 1
+                change()
+                state[0] += 1
+                time.sleep(0.002)
+            counts['rebinds'] += 1
+
+    # switch threads as often as possible, to make the races likely
+    interval = sys.getcheckinterval()
+    sys.setcheckinterval(1)
+    try:
+        threads = [threading.Thread(target=reader, args=(i * 7919,))
+                   for i in range(readers)]
+        w = threading.Thread(target=writer)
+        w.start()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        done.set()
+        w.join()
+    finally:
+        sys.setcheckinterval(interval)
+    return counts
+
+
+def bench_routing(requests, bindings, depth):
+    """Dispatch.lookup() alone, cold (no cache) and with the route cache."""
+    results = {}
+    urls = [p + '/extra.json?q=1' for p in paths(bindings, depth)]
+    random.shuffle(urls)
+    for label, cache in (('uncached', 0), ('cached', 1024)):
+        server = make_server(0, bindings, depth)
+        server.dispatch.route_cache(cache)
+        lookup = server.dispatch.lookup
+        latencies = []
+        start = time.time()
+        for i in xrange(requests):
+            t = time.time()
+            lookup(urls[i % len(urls)])
+            latencies.append(time.time() - t)
+        results[label] = summary(latencies, 0, time.time() - start)
+    return results
+
+
+class CountingSocket:
+    """
+    Passes calls through to a socket, counting the send() and recv()
+    system calls. sendall() is done as the send()s it would take.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.sends = 0
+        self.recvs = 0
+
+    def send(self, data):
+        self.sends += 1
+        return self.sock.send(data)
+
+    def sendall(self, data):
+        view = memoryview(data)
+        sent = 0
+        while sent < len(view):
+            sent += self.send(view[sent:])
+
+    def recv(self, size):
+        self.recvs += 1
+        return self.sock.recv(size)
+
+    def makefile(self, mode='r', bufsize=-1):
+        return socket._fileobject(self, mode, bufsize)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+def pipelined(server, url, count):
+    """
+    Answers count pipelined GETs of url with one MyHTTPRequestHandler,
+    in this process, over a loopback connection that a pair of threads
+    writes the requests to and reads the responses from. Returns
+    (seconds, conn), conn being the CountingSocket the handler used.
+    """
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    client = socket.create_connection(listener.getsockname())
+    conn = CountingSocket(listener.accept()[0])
+    listener.close()
+
+    request = 'GET %s HTTP/1.1\r\nHost: x\r\n\r\n' % url
+    talk = [threading.Thread(target=client.sendall, args=(
+                request * (count - 1) + request.replace(
+                    'Host: x', 'Host: x\r\nConnection: close'),)),
+            threading.Thread(target=lambda: list(iter(
+                lambda: client.recv(1048576), '')))]
+    for t in talk:
+        t.start()
+    start = time.time()
+    microhttpd.MyHTTPRequestHandler(conn, ('127.0.0.1', 0), server)
+    seconds = time.time() - start
+    conn.close()
+    for t in talk:
+        t.join()
+    client.close()
+    return seconds, conn
+
+
+def bench_writes(requests, body_size):
+    """
+    send() and recv() calls per request, for small and large GETs, with
+    and without coalescing. Everything runs in this process, see
+    pipelined().
+    """
+    handler = microhttpd.MyHTTPRequestHandler
+    saved = (handler.coalesce, handler.disable_nagle_algorithm, sys.stderr)
+    server = make_server(0, 1, 1, body_size)
+    results = {}
+    try:
+        sys.stderr = open(os.devnull, 'w')
+        for label, coalesce in (('separate', False), ('coalesced', True)):
+            handler.coalesce = handler.disable_nagle_algorithm = coalesce
+            results[label] = {}
+            for name, url, count in (('small', '/b0', requests),
+                                     ('large', '/large',
+                                      max(requests // 100, 1))):
+                seconds, conn = pipelined(server, url, count)
+                results[label][name] = {
+                    'requests': count,
+                    'seconds': round(seconds, 3),
+                    'rps': round(count / seconds, 1),
+                    'sends_per_request': round(conn.sends / float(count), 2),
+                    'recvs_per_request': round(conn.recvs / float(count), 2)}
+    finally:
+        handler.coalesce, handler.disable_nagle_algorithm, sys.stderr = saved
+    return results
+
+
+def result_bytes(dispatch, url):
+    """
+    What one call's result for url takes up that the next call doesn't
+    share: the dict or Response and its header list, or nothing for a
+    frozen Response, which is the same one every time.
+    """
+    first = dispatch.call(url, 'GET', '')
+    second = dispatch.call(url, 'GET', '')
+    if first is second:
+        return 0
+    size = sys.getsizeof(first)
+    headers = first.get('h')
+    if headers is not None and headers is not second.get('h'):
+        size += sys.getsizeof(headers)
+    return size
+
+
+def bench_results(requests):
+    """
+    The same small answer as a dict, a Response and a frozen Response,
+    each answered requests times through pipelined().
+    """
+    server = make_server(0, 1, 1, 1)
+    results = {}
+    saved = sys.stderr
+    try:
+        sys.stderr = open(os.devnull, 'w')
+        for name, url in (('dict', '/b0'), ('response', '/response'),
+                          ('frozen', '/frozen')):
+            if tracemalloc is not None:
+                tracemalloc.start()
+            seconds, conn = pipelined(server, url, requests)
+            result = {'requests': requests,
+                      'seconds': round(seconds, 3),
+                      'rps': round(requests / seconds, 1),
+                      'result_bytes': result_bytes(server.dispatch, url)}
+            if tracemalloc is not None:
+                result['traced_peak_kb'] = round(
+                    tracemalloc.get_traced_memory()[1] / 1024.0, 1)
+                tracemalloc.stop()
+            results[name] = result
+    finally:
+        sys.stderr = saved
+    return results
+
+
+def run(scenario, options):
+    if scenario == 'routing':
+        return bench_routing(options['requests'], options['bindings'],
+                             options['depth'])
+    if scenario == 'writes':
+        return bench_writes(options['requests'], options['body_size'])
+    if scenario == 'results':
+        return bench_results(options['requests'])
+
+    pid, port = start_server(bindings=options['bindings'],
+                             depth=options['depth'],
+                             body_size=options['body_size'],
+                             mode=options['mode'],
+                             workers=options['workers'],
+                             lean=options['lean'])
+    try:
+        urls = [p + '/x' for p in paths(options['bindings'], options['depth'])]
+        requests = options['requests']
+        concurrency = options['concurrency']
+        if scenario == 'keepalive':
+            return drive(port, requests, concurrency, urls=urls)
+        if scenario == 'newconn':
+            return drive(port, requests, concurrency, urls=urls,
+                         keepalive=False)
+        if scenario == 'large':
+            return drive(port, max(requests // 100, concurrency), concurrency,
+                         urls=['/large'])
+        if scenario == 'upload':
+            return drive(port, max(requests // 100, concurrency), concurrency,
+                         'PUT', ['/upload'], 'x' * options['body_size'])
+        if scenario == 'batch':
+            size = options['batch']
+            body = json.dumps([['GET', url] for url in urls[:size]])
+            result = drive(port, max(requests // size, concurrency),
+                           concurrency, 'POST', ['/batch'], body)
+            result['requests'] *= size
+            if result['rps']:
+                result['rps'] = round(result['rps'] * size, 1)
+            return result
+        if scenario == 'rebind':
+            done = threading.Event()
+            t, counts = rebinding(port, done)
+            try:
+                result = drive(port, requests, concurrency, urls=urls)
+            finally:
+                done.set()
+                t.join()
+            result.update(counts)
+            result['rebinds_per_second'] = round(
+                counts['rebinds'] / result['seconds'], 1)
+            result['routes'] = check_routes(requests, options['bindings'],
+                                            options['depth'])
+            return result
+        raise ValueError('unknown scenario: %r' % scenario)
+    finally:
+        stop_server(pid)
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+
+    parser = OptionParser("usage: %prog [options] [scenario ...]\n\n"
+                          "scenarios: " + ', '.join(scenarios))
+    parser.add_option("-m", "--mode", dest="mode", default="thread",
+                      type="choice", choices=['single', 'thread', 'fork', 'async'],
+                      help="Server concurrency mode. Default is thread")
+    parser.add_option("-w", "--workers", dest="workers", default=8, type="int",
+                      help="Server worker threads. Default is 8")
+    parser.add_option("-c", "--concurrency", dest="concurrency", default=8,
+                      type="int", help="Client threads. Default is 8")
+    parser.add_option("-n", "--requests", dest="requests", default=10000,
+                      type="int",
+                      help="Requests per scenario (large and upload send "
+                      "1/100th of this). Default is 10000")
+    parser.add_option("-b", "--bindings", dest="bindings", default=100,
+                      type="int", help="URLs to bind. Default is 100")
+    parser.add_option("-d", "--depth", dest="depth", default=3, type="int",
+                      help="Segments in each bound URL. Default is 3")
+    parser.add_option("-s", "--body-size", dest="body_size", default=1048576,
+                      type="int",
+                      help="Body size for large and upload. Default is 1MB")
+    parser.add_option("-B", "--batch", dest="batch", default=20, type="int",
+                      help="GETs per POST in the batch scenario. Default is 20")
+    parser.add_option("-L", "--lean", dest="lean", default=False,
+                      action="store_true",
+                      help="Serve with the lean request parser")
+    parser.add_option("-o", "--output", dest="output", default=None,
+                      help="Write the JSON results here as well as to stdout")
+    (opts, args) = parser.parse_args()
+
+    for scenario in args:
+        if scenario not in scenarios:
+            parser.error('unknown scenario: %s' % scenario)
+
+    options = dict(vars(opts))
+    results = {'options': options, 'python': sys.version.split()[0],
+               'results': {}}
+    for scenario in args or scenarios:
+        results['results'][scenario] = run(scenario, options)
+
+    text = json.dumps(results, indent=2, sort_keys=True)
+    print text
+    if opts.output:
+        f = open(opts.output, 'w')
+        f.write(text + '\n')
+        f.close()
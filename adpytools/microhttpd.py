@@ -52,8 +52,8 @@ Also, if you bind
 
 Then anything beginning with /foo/bar will match the latter and
 anything beginning with /foo but not /foo/bar will match the
-former. Basically, the match works backwards, one URL segment at a
-time to look for a match.
+former. Basically, the longest bound prefix, counted in whole URL
+segments, wins.
 
 Matches work if extensions are present as well. An emerging trend in
 REST is to use things like /foo.json or /foo.html to ask for specific
@@ -84,11 +84,27 @@ as described above.
 If you do not set a "default", then the microserver will let you do
 GETs on files and subdirectories. Be careful to make sure this is what
 you want! (Maybe there should be a way to set/clear this behavior with
-a method in dispatch...)
+a method in dispatch...) Files are sent with sendfile() where possible,
+and support Range requests and If-None-Match/If-Modified-Since.
 
 There's a URL munging function that lets you correct for the use of
 Apache (or other) rewriting schemes.
 
+A function that always gives the same answer for the same arguments
+can be bound with a cache_ttl, and then GETs on it are answered from a
+response cache for that many seconds, with an ETag that clients can
+revalidate with If-None-Match. One that takes a lot of CPU can be
+bound to a pool of worker processes (see Dispatch.pool()), so that it
+doesn't hold everything else up.
+
+Clients that would otherwise poll can be sent events as they happen
+instead, with Server-Sent Events: bind server.events.handler, and call
+server.publish(). See EventHub.
+
+Server.batch() binds a URL that takes a list of requests in one POST
+and answers them all at once, which saves clients that need dozens of
+bound URLs a round trip for each.
+
 Each function or method is called with these arguments -
 
   type  GET, PUT, POST, DELETE, etc.
@@ -96,6 +112,8 @@ Each function or method is called with these arguments -
   ext   The part of the incoming URL behind the last '.' character
         e.g. '.ext' from 'match.ext'
   rest  The rest of the incoming URL after the match and any ext
+        (but for a PUT, the request body, and for a binding made with
+        stream=True, a RequestBody to read the body from - see bind())
   note  An optional string that was passed in at bind time (or None)
 
   GET on /foo/bar.baz?stuff matched to /foo/bar would yield:
@@ -108,15 +126,25 @@ Each function or method is called with these arguments -
 Each function must return a dictionary with the following information:
 {
   'c': <http result code>       OPTIONAL - if you leave this off,
-                                it defaults to httplib.OK, if you use
-                                it, then 1xx, 2xx, and 3xx return
-                                normally
-                                4xx and 5xx use BaseHTTPServer.send_error
+                                it defaults to httplib.OK. Any code
+                                goes out with the 'r' and 'h' you
+                                give, but a 4xx or 5xx without an
+                                'r' gets BaseHTTPServer.send_error's
+                                HTML error page instead. A 'c' of
+                                httplib.NOT_FOUND means the function
+                                didn't handle the request at all: a
+                                GET falls back to serving files, and
+                                anything else gets send_error's 404
 
   'r': response body            OPTIONAL - if you leave this off,
                                 it defaults to nothing being returned.
-                                If you use it, then it's a string of all
-                                the data to be returned.
+                                If you use it, then it's either a string
+                                of all the data to be returned, or a
+                                file-like object or an iterator/generator
+                                of strings that gets streamed out as it
+                                is read. Files that can seek are sent
+                                with a Content-Length, anything else with
+                                chunked transfer-encoding.
 
   'h': list of headers          OPTIONAL - if you leave this off, then
                                 the 'standard' headers for your response
@@ -126,6 +154,13 @@ Each function must return a dictionary with the following information:
                                 is the content.
 }
 
+or a Response, which holds the same things without being a dict. For
+an answer that never changes, bind constant to a frozen Response; its
+headers are turned into bytes once rather than on every request:
+
+  server.dispatch.bind('/version', constant, Response(
+      __version__ + "\n", [('Content-type', "text/plain")], frozen=True))
+
 Example:
 
 import microhttpd
@@ -134,6 +169,12 @@ microhttpd.server.dispatch.bind('/exit', microhttpd.exit)
 microhttpd.server.dispatch.bind('/', microhttpd.echo, "Hello World\n")
 microhttpd.server.serve_forever()
 
+SIGTERM stops the server gracefully: it stops accepting, lets the
+requests in progress finish (for up to 10 seconds) and then returns from
+serve_forever(). SIGHUP does a hot restart: the program is started again
+on the same listening socket, and this copy shuts down gracefully once
+the new one is serving. See Server.graceful() to change any of that.
+
 """
 
 # Python imports
@@ -143,21 +184,151 @@ import SocketServer
 import httplib
 import time
 import BaseHTTPServer
+import cPickle
+import cProfile
+import pstats
 import SimpleHTTPServer
+import Queue
+import asynchat
+import asyncore
+import bisect
+import collections
+import email.utils
+import errno
+import fcntl
+import hashlib
+import itertools
+import json
+import random
+import re
+import mmap
+import multiprocessing
+import select
+import signal
+import socket
+import stat
+import threading
+import traceback
+import urlparse
+import StringIO
+import zlib
+
+# sendfile() is in os from Python 3.3 on, and in the pysendfile package
+# before that. Without it, static files are sent from an mmap instead.
+try:
+    sendfile = os.sendfile
+except AttributeError:
+    try:
+        from sendfile import sendfile
+    except ImportError:
+        sendfile = None
 
 # adpytools imports
-from debugging import Debug
+from debugging import Debug, DebugFlag, DebugMessage
 __version__ = '$Id: microhttpd.py 11 2007-05-23 18:31:48Z adoyle $'
 if Debug("version"): print __version__
 
-# used to track requests in multi-threaded mode
-serial = 0
+# checked on every request, so looked up once here
+DEBUG_HTTP = DebugFlag("http")
+DEBUG_HTTPTIME = DebugFlag("httptime")
+
+# used to track requests in multi-threaded mode; next() on it is atomic
+serials = itertools.count(1)
+
+
+class Response(object):
+    """
+    What a bound function can return instead of the result dict, with
+    the same three things in it as attributes instead of keys:
+
+      return Response("hello\n", [('Content-type', "text/plain")])
+
+    is the same as returning
+
+      {'r': "hello\n", 'h': [('Content-type', "text/plain")], 'c': 200}
+
+    without a dict to build and throw away on every request. It answers
+    get(), [] and keys() like the dict does, so code that looks at
+    results (caches, pools, batches) works with either.
+
+    With frozen=True it's for an answer that never changes, made once
+    and returned from every call, like the one constant() hands back.
+    The body has to be a str then. Its headers, with the Content-Length
+    added, are put together as the bytes that go out on the wire up
+    front, and it can't be changed afterwards.
+    """
+    __slots__ = ('c', 'h', 'r', 'head', 'ctype')
+
+    def __init__(self, body=None, headers=None, code=httplib.OK,
+                 frozen=False):
+        setattr_ = object.__setattr__
+        setattr_(self, 'head', None)
+        setattr_(self, 'c', code)
+        setattr_(self, 'r', body)
+        if not frozen:
+            setattr_(self, 'h', headers)
+            return
+
+        if not isinstance(body, str):
+            raise TypeError('a frozen Response needs a str body, not %r'
+                            % type(body))
+        headers = tuple([(name, value) for name, value in headers or ()])
+        ctype = None
+        lines = []
+        for name, value in headers:
+            lower = name.lower()
+            if lower in ('connection', 'content-length',
+                         'transfer-encoding'):
+                raise ValueError("a frozen Response can't set %s" % name)
+            if lower == 'content-type' and ctype is None:
+                ctype = value
+            elif lower == 'content-encoding':
+                ctype = ''  # already encoded, so never compressed
+            lines.append("%s: %s\r\n" % (name, value))
+        lines.append("Content-Length: %d\r\n" % len(body))
+        setattr_(self, 'h', headers)
+        setattr_(self, 'ctype', ctype)
+        setattr_(self, 'head', ''.join(lines))
+
+    def __setattr__(self, name, value):
+        if self.head is not None:
+            raise AttributeError("frozen Response can't be changed")
+        object.__setattr__(self, name, value)
+
+    def __reduce__(self):
+        # unpickling (for process pools) sets slots one by one, which a
+        # frozen one won't allow, so make it over again instead
+        return (Response, (self.r, self.h, self.c, self.head is not None))
+
+    def compressible(self, compression):
+        """Whether compression could have anything to do to a frozen one."""
+        return self.c == httplib.OK and bool(self.ctype) and \
+            compression.compressible(self.ctype)
+
+    def get(self, key, default=None):
+        if key in ('c', 'h', 'r'):
+            return getattr(self, key)
+        return default
+
+    def __getitem__(self, key):
+        if key in ('c', 'h', 'r'):
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def keys(self):
+        return ['c', 'h', 'r']
+
+    def __repr__(self):
+        return 'Response(%r, %r, %r%s)' % (self.r, self.h, self.c,
+                                           self.head is not None and
+                                           ', frozen=True' or '')
 
 
 # Some sample functions. Should probably be contingent on __main__
 def exit(type, match, ext, rest, note):
-    """Makes the server exit."""
-    os._exit(0)
+    """Makes the server exit, once the requests in progress are answered."""
+    server.shutdown()
+    return ({'h': [('Content-type', "text/plain")], 'r': "exiting\n"})
 
 
 def echo(type, match, ext, rest, note):
@@ -169,6 +340,11 @@ def echo(type, match, ext, rest, note):
     })
 
 
+def constant(type, match, ext, rest, note):
+    """Returns note, which should be a frozen Response, every time"""
+    return note
+
+
 def urltest(type, match, ext, rest, note):
     """Returns some HTML that should contain a link back to itself"""
     return ({
@@ -179,9 +355,840 @@ def urltest(type, match, ext, rest, note):
     })
 
 
+class BodyError(Exception):
+    """
+    Raised while reading a request body (or, for the lean parser, a
+    request head) that is too big, cut short or badly chunked. code is
+    the HTTP status to answer with.
+    """
+
+    def __init__(self, code, message):
+        Exception.__init__(self, message)
+        self.code = code
+
+
+class SocketReader:
+    """
+    The rfile for the lean parser (see MyHTTPRequestHandler.lean): reads
+    from the connection in big pieces with recv, and hands back a whole
+    request head at once, found with a single find() over what has come
+    in, instead of reading it line by line. read() and readline() work
+    like they do for files, for the request body.
+    """
+    bufsize = 65536
+
+    def __init__(self, recv):
+        self.recv_into_buffer = recv
+        self.buf = ''
+
+    def recv(self, size):
+        while True:
+            try:
+                return self.recv_into_buffer(size)
+            except socket.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+
+    def read_head(self, limit):
+        """
+        Reads a request head, up to the blank line that ends it, and
+        returns it without its last line break. Empty lines before it
+        are skipped. Returns '' if the connection closes before anything
+        arrives; raises BodyError if it closes in the middle of the head,
+        or the head goes past limit bytes.
+        """
+        start = 0
+        while True:
+            if self.buf[:1] in ('\r', '\n'):
+                self.buf = self.buf.lstrip('\r\n')
+                start = 0
+            crlf = self.buf.find('\n\r\n', start)
+            lf = self.buf.find('\n\n', start,
+                               crlf >= 0 and crlf + 1 or len(self.buf))
+            end = lf >= 0 and lf or crlf
+            if 0 <= end <= limit:
+                head = self.buf[:end]
+                self.buf = self.buf[end + (lf >= 0 and 2 or 3):]
+                return head
+            if end > limit or len(self.buf) > limit:
+                raise BodyError(httplib.REQUEST_ENTITY_TOO_LARGE,
+                                'request head over %d bytes' % limit)
+            start = max(len(self.buf) - 2, 0)
+            data = self.recv(self.bufsize)
+            if not data:
+                if self.buf:
+                    raise BodyError(httplib.BAD_REQUEST,
+                                    'request head cut short')
+                return ''
+            self.buf += data
+
+    def read(self, size=-1):
+        pieces = [self.buf]
+        have = len(self.buf)
+        while size < 0 or have < size:
+            data = self.recv(max(self.bufsize, size - have))
+            if not data:
+                break
+            pieces.append(data)
+            have += len(data)
+        data = ''.join(pieces)
+        if size < 0:
+            size = have
+        self.buf = data[size:]
+        return data[:size]
+
+    def readline(self, limit=-1):
+        start = 0
+        while True:
+            end = self.buf.find('\n', start) + 1
+            if end:
+                break
+            if 0 <= limit <= len(self.buf):
+                end = limit
+                break
+            start = len(self.buf)
+            data = self.recv(self.bufsize)
+            if not data:
+                end = len(self.buf)
+                break
+            self.buf += data
+        if 0 <= limit < end:
+            end = limit
+        line, self.buf = self.buf[:end], self.buf[end:]
+        return line
+
+    def close(self):
+        self.buf = ''
+
+
+class SocketWriter:
+    """
+    The wfile MyHTTPRequestHandler writes responses to (see coalesce).
+    Writes pile up here until flush(), or until there's bufsize of them,
+    and then go out with a single sendall(), so the status line, headers
+    and body of a response leave in one send instead of one per header
+    line, and don't get held back by Nagle's algorithm waiting for the
+    client to acknowledge the first of them.
+    """
+    bufsize = 65536
+
+    def __init__(self, sendall):
+        self.sendall = sendall
+        self.pieces = []
+        self.size = 0
+        self.closed = False
+
+    def write(self, data):
+        if data:
+            self.pieces.append(data)
+            self.size += len(data)
+            if self.size >= self.bufsize:
+                self.flush()
+
+    def flush(self):
+        if self.pieces:
+            if len(self.pieces) == 1:
+                data = self.pieces[0]
+            else:
+                data = ''.join(self.pieces)
+            self.pieces = []
+            self.size = 0
+            self.sendall(data)
+
+    def close(self):
+        self.pieces = []
+        self.size = 0
+        self.closed = True
+
+
+class LazyHeaders:
+    """
+    Request headers as the lean parser leaves them: the raw header
+    block, which get() searches for the one header asked for, so a
+    request costs nothing for headers nobody looks at. Only things that
+    need every header (keys(), items() and so on) split it all up.
+
+    Covers the parts of mimetools.Message that the handlers here use:
+    get(), getheader(), getheaders(), [], in, keys(), values(), items()
+    and str(). As with mimetools, the last of repeated headers wins.
+    """
+
+    def __init__(self, block):
+        # '\nName: value\r\nName: value\r', each line after a line break
+        self.block = block
+        self.lower = None
+        self.lines = None
+        self.dict = None
+
+    def get(self, name, default=None):
+        name = name.lower()
+        if self.dict is not None:
+            return self.dict.get(name, default)
+        if self.lower is None:
+            self.lower = self.block.lower()
+        key = '\n' + name + ':'
+        i = self.lower.rfind(key)
+        if i < 0:
+            return default
+        start = i + len(key)
+        end = self.block.find('\n', start)
+        if end < 0:
+            end = len(self.block)
+        elif self.block[end + 1:end + 2] in (' ', '\t'):
+            # folded onto the next line; rare enough to do the long way
+            return self.parse().get(name, default)
+        return self.block[start:end].strip()
+
+    getheader = get
+
+    def parse(self):
+        if self.dict is None:
+            self.lines = []
+            for line in self.block.split('\n')[1:]:
+                if line[:1] in (' ', '\t') and self.lines:
+                    name, value = self.lines[-1]
+                    self.lines[-1] = (name, value + ' ' + line.strip())
+                    continue
+                name, colon, value = line.partition(':')
+                self.lines.append((name, value.strip()))
+            self.dict = dict([(name.lower(), value)
+                              for name, value in self.lines])
+        return self.dict
+
+    def getheaders(self, name):
+        self.parse()
+        name = name.lower()
+        return [value for key, value in self.lines if key.lower() == name]
+
+    def __getitem__(self, name):
+        value = self.get(name)
+        if value is None:
+            raise KeyError(name)
+        return value
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    has_key = __contains__
+
+    def keys(self):
+        return self.parse().keys()
+
+    def values(self):
+        return self.parse().values()
+
+    def items(self):
+        return self.parse().items()
+
+    def __len__(self):
+        return len(self.parse())
+
+    def __iter__(self):
+        return iter(self.parse())
+
+    def __str__(self):
+        self.parse()
+        return ''.join(['%s: %s\r\n' % line for line in self.lines])
+
+
+# A line break in a header block that isn't followed by the start of a
+# "Name:" header or a folded continuation line. Whitespace between the
+# name and the colon is refused too, since proxies disagree about it.
+bad_header_line = re.compile(r'\n(?![!#$%&\'*+.^_`|~0-9A-Za-z-]+:|[ \t])')
+
+
+class RequestBody:
+    """
+    File-like view of a request body, read off the connection only as
+    the bound function asks for it. Works for bodies sent with a
+    Content-Length or with chunked transfer-encoding, and raises
+    BodyError(413) once more than 'limit' bytes have arrived (if limit
+    is set).
+
+    read(size) works like it does for files; iterating gives pieces of
+    up to 'bufsize' bytes until the body is used up. 'length' is the
+    Content-Length, or None for a chunked body. For bindings made with
+    stream=True, 'rest' holds what the function would otherwise have
+    been given as its rest argument.
+    """
+    bufsize = 65536
+
+    def __init__(self, rfile, length=0, chunked=False, limit=None):
+        self.rfile = rfile
+        self.length = length
+        self.chunked = chunked
+        self.limit = limit
+        self.remaining = length or 0
+        self.received = 0
+        self.chunk_left = 0
+        self.done = not chunked and not length
+        self.rest = ''
+
+    def __iter__(self):
+        return iter(lambda: self.read(self.bufsize), '')
+
+    def read(self, size=-1):
+        if self.chunked:
+            return self.read_chunked(size)
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        if not size:
+            return ''
+        data = self.rfile.read(size)
+        self.remaining -= len(data)
+        self.received += len(data)
+        if len(data) < size:
+            self.remaining = 0
+            raise BodyError(httplib.BAD_REQUEST, 'request body cut short')
+        self.done = self.remaining == 0
+        return data
+
+    def read_chunked(self, size):
+        pieces = []
+        while not self.done and size != 0:
+            if not self.chunk_left:
+                self.next_chunk()
+                continue
+            n = self.chunk_left
+            if 0 < size < n:
+                n = size
+            piece = self.rfile.read(n)
+            if len(piece) < n:
+                self.done = True
+                raise BodyError(httplib.BAD_REQUEST, 'request body cut short')
+            self.chunk_left -= n
+            if not self.chunk_left:
+                self.rfile.readline(1024)  # the CRLF after the chunk data
+            pieces.append(piece)
+            if size > 0:
+                size -= n
+        return ''.join(pieces)
+
+    def next_chunk(self):
+        line = self.rfile.readline(1024)
+        try:
+            size = int(line.split(';', 1)[0].strip(), 16)
+        except ValueError:
+            self.done = True
+            raise BodyError(httplib.BAD_REQUEST, 'bad chunk size %r' % line)
+        if size < 0:
+            self.done = True
+            raise BodyError(httplib.BAD_REQUEST, 'bad chunk size %r' % line)
+        if size == 0:
+            # skip any trailers, up to the blank line that ends the body
+            while True:
+                line = self.rfile.readline(65537)
+                if line in ('\r\n', '\n', ''):
+                    break
+            self.done = True
+            return
+        self.received += size
+        if self.limit and self.received > self.limit:
+            self.done = True
+            raise BodyError(httplib.REQUEST_ENTITY_TOO_LARGE,
+                            'request body over %d bytes' % self.limit)
+        self.chunk_left = size
+
+    def drain(self, limit):
+        """
+        Reads and throws away whatever is left, giving up after 'limit'
+        bytes. Returns True if the whole body got read, which means the
+        next request on the connection starts in the right place.
+        """
+        try:
+            while not self.done:
+                if limit <= 0:
+                    return False
+                limit -= len(self.read(min(limit, self.bufsize)))
+        except BodyError:
+            return False
+        return True
+
+
+class Flight:
+    """One call that ResponseCache is waiting on, and its result."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+
+class ResponseCache:
+    """
+    Results of GETs to bindings made with a cache_ttl, keyed on what the
+    function was called with (binding, match, ext, rest), for cache_ttl
+    seconds. Only plain 200 responses with a string body are kept; each
+    gets an ETag (unless the function set one) so clients can come back
+    with If-None-Match and get a 304.
+
+    Entries are dropped least recently used first to keep the bodies and
+    headers under max_bytes in total.
+
+    When several requests miss on the same key at once, only the first
+    calls the function; the rest wait for it and share its result.
+
+    clear() bumps a generation number, as RouteCache's does, and a call
+    that started before it doesn't store its result, so a function that
+    was rebound while it ran can't leave its answer behind.
+    """
+
+    def __init__(self, max_bytes=16 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.generation = 0
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def get(self, key, ttl, function, generation=None):
+        """
+        Returns the cached result for key, or what function() returns.
+        generation is the one current when the caller decided function
+        was the right one to call; by default it's read here.
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                if entry[0] > time.time():
+                    self.entries[key] = entry
+                    self.hits += 1
+                    return dict(entry[1])
+                self.size -= entry[2]
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+                if generation is None:
+                    generation = self.generation
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.result is not None:
+                return dict(flight.result)
+            # The call failed, or gave something that can't be shared
+            # (a stream, an error), so make our own.
+            return function()
+
+        try:
+            result = function()
+            if self.cacheable(result):
+                result = self.store(key, ttl, result, generation)
+                flight.result = result
+                return dict(result)
+            return result
+        finally:
+            with self.lock:
+                # clear() may have let a newer flight take our place
+                if self.flights.get(key) is flight:
+                    del self.flights[key]
+            flight.done.set()
+
+    def cacheable(self, result):
+        return result.get('c', httplib.OK) == httplib.OK and \
+            isinstance(result.get('r'), basestring)
+
+    def store(self, key, ttl, result, generation):
+        headers = list(result.get('h') or [])
+        for name, value in headers:
+            if name.lower() == 'etag':
+                break
+        else:
+            headers.append(('ETag', '"%s"' % hashlib.md5(
+                result['r']).hexdigest()[:20]))
+        result = {'c': httplib.OK, 'r': result['r'], 'h': headers}
+        size = len(result['r']) + sum([len(str(name)) + len(str(value))
+                                       for name, value in headers]) + 200
+        if size > self.max_bytes:
+            return result
+        with self.lock:
+            if generation != self.generation:
+                return result
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[2]
+            self.entries[key] = (time.time() + ttl, result, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                self.size -= self.entries.popitem(last=False)[1][2]
+                self.evictions += 1
+        return result
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+            self.size = 0
+            # calls already running are for the old bindings, so later
+            # requests shouldn't wait for them and share what they get
+            self.flights.clear()
+
+    def stats(self):
+        return {'max_bytes': self.max_bytes, 'bytes': self.size,
+                'entries': len(self.entries), 'hits': self.hits,
+                'misses': self.misses, 'coalesced': self.coalesced,
+                'evictions': self.evictions}
+
+
+class RouteCache:
+    """
+    Bounded least-recently-used map from a URL path (with the query
+    already stripped off) to what Dispatch.resolve() found for it, with
+    counters so you can tell whether it is earning its keep.
+
+    clear() bumps a generation number. put() is given the generation
+    that was current before the lookup it is caching started, and drops
+    the entry if the bindings changed in the meantime.
+    """
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, path):
+        """Returns (True, route) on a hit, (False, None) on a miss."""
+        try:
+            route = self.entries.pop(path)
+        except KeyError:
+            self.misses += 1
+            return (False, None)
+        self.entries[path] = route
+        self.hits += 1
+        return (True, route)
+
+    def put(self, path, route, generation):
+        if generation != self.generation:
+            return
+        self.entries[path] = route
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self.generation += 1
+        self.entries.clear()
+
+    def stats(self):
+        return {'size': self.size, 'entries': len(self.entries),
+                'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions}
+
+
+class LockedRouteCache(RouteCache):
+    """RouteCache that can be shared by several request threads."""
+
+    def __init__(self, size=1024):
+        RouteCache.__init__(self, size)
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        with self.lock:
+            return RouteCache.get(self, path)
+
+    def put(self, path, route, generation):
+        with self.lock:
+            RouteCache.put(self, path, route, generation)
+
+    def clear(self):
+        with self.lock:
+            RouteCache.clear(self)
+
+
+# the Dispatch a ProcessOffload worker process looks its bindings up in
+offload_dispatch = None
+
+
+def offload_worker_start(dispatch):
+    """Sets up a ProcessOffload worker process."""
+    global offload_dispatch
+    offload_dispatch = dispatch
+    # stopping and restarting are the server's business, not ours
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGHUP, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    parent = os.getppid()
+
+    def orphaned():
+        while os.getppid() == parent:
+            time.sleep(1)
+        os._exit(0)
+    t = threading.Thread(target=orphaned)
+    t.setDaemon(True)
+    t.start()
+
+
+def offload_worker_call(key, type, match, ext, rest):
+    """
+    Calls the function bound to key in a ProcessOffload worker, and
+    returns (True, result) or (False, traceback), pickled.
+    """
+    try:
+        binding = offload_dispatch.bindings[key]
+        result = dict(binding["method"](type=type, match=match, ext=ext,
+                                        rest=rest, note=binding["note"]))
+        body = result.get('r')
+        if body is not None and event_stream(result.get('h')):
+            # it would never end, and this worker with it
+            close = getattr(body, 'close', None)
+            if close is not None:
+                close()
+            result = {'c': httplib.INTERNAL_SERVER_ERROR,
+                      'h': [('Content-type', 'text/plain')],
+                      'r': 'event streams can\'t come from a process pool\n'}
+        elif body is not None and not isinstance(body, basestring):
+            # files and generators can't go through a pipe
+            if hasattr(body, 'read'):
+                result['r'] = body.read()
+            else:
+                result['r'] = ''.join(body)
+            close = getattr(body, 'close', None)
+            if close is not None:
+                close()
+        return cPickle.dumps((True, result), cPickle.HIGHEST_PROTOCOL)
+    except Exception:
+        return cPickle.dumps((False, traceback.format_exc()),
+                             cPickle.HIGHEST_PROTOCOL)
+
+
+class Offload:
+    """
+    Somewhere other than the request's own thread for the bindings made
+    with pool=<name> to run (see Dispatch.pool). At most max_pending
+    calls can be running or waiting to run at once; past that they're
+    answered with a 503 straight away. A call that takes longer than
+    timeout seconds is answered with a 504, although it carries on
+    running, and (unless release_on_timeout is set) holding its place,
+    until it's done.
+
+    The workers start on first use, or when start() is called, and are
+    started again in a process that was forked off after that.
+    """
+    kind = None
+    release_on_timeout = False
+
+    def __init__(self, name, dispatch, workers=4, max_pending=None,
+                 timeout=None, retry_after=1):
+        self.name = name
+        self.dispatch = dispatch
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.slots = None
+        if max_pending:
+            self.slots = threading.Semaphore(max_pending)
+        self.metrics = None
+        self.lock = threading.Lock()
+        self.pool = None
+        self.pid = None
+        self.stale = False
+
+    def start(self):
+        with self.lock:
+            if self.pool is None or self.pid != os.getpid() or self.stale:
+                if self.pool is not None and self.pid == os.getpid():
+                    self.retire(self.pool)
+                self.pool = self.make_pool()
+                self.pid = os.getpid()
+                self.stale = False
+            return self.pool
+
+    def rebound(self):
+        """Called when the bindings change."""
+        pass
+
+    def stop(self, timeout=None):
+        with self.lock:
+            if self.pool is not None and self.pid == os.getpid():
+                self.retire(self.pool, timeout)
+            self.pool = None
+
+    def call(self, key, binding, type, match, ext, rest):
+        """What the function bound to key returns, or a 503 or 504."""
+        if self.slots is not None and not self.slots.acquire(False):
+            if self.metrics is not None:
+                self.metrics.count('microhttpd_rejected_total',
+                                   reason='pool_full', pool=self.name)
+            return {'c': httplib.SERVICE_UNAVAILABLE,
+                    'h': [('Content-type', 'text/plain'),
+                          ('Retry-After', str(self.retry_after))],
+                    'r': 'too busy, try again later\n'}
+
+        done = threading.Event()
+        outcome = []
+        held = [self.slots is not None]
+        lock = threading.Lock()
+
+        def release():
+            # once only, whichever of finish and the timeout comes first
+            with lock:
+                if held[0]:
+                    held[0] = False
+                    self.slots.release()
+
+        def finish(result):
+            outcome.append(result)
+            release()
+            done.set()
+        try:
+            self.submit(finish, key, binding, type, match, ext, rest)
+        except:
+            release()
+            raise
+
+        if not done.wait(self.timeout):
+            if self.release_on_timeout:
+                release()
+            if self.metrics is not None:
+                self.metrics.count('microhttpd_pool_timeouts_total',
+                                   pool=self.name)
+            return {'c': httplib.GATEWAY_TIMEOUT,
+                    'h': [('Content-type', 'text/plain')],
+                    'r': 'gave up waiting for an answer\n'}
+        return self.result(key, outcome[0])
+
+
+class ThreadOffload(Offload):
+    """An Offload onto a WorkerPool of its own."""
+    kind = 'thread'
+
+    def make_pool(self):
+        return WorkerPool(self.workers)
+
+    def retire(self, pool, timeout=None):
+        pool.stop(timeout)
+
+    def submit(self, finish, key, binding, type, match, ext, rest):
+        def job():
+            try:
+                result = (True, binding["method"](
+                    type=type, match=match, ext=ext, rest=rest,
+                    note=binding["note"]))
+            except Exception:
+                result = (False, sys.exc_info())
+            finish(result)
+        self.start().submit(job)
+
+    def result(self, key, outcome):
+        ok, value = outcome
+        if not ok:
+            raise value[0], value[1], value[2]
+        return value
+
+
+class ProcessOffload(Offload):
+    """
+    An Offload onto worker processes, for functions that keep the CPU
+    busy, and so would hold the GIL and slow every other request down.
+
+    The workers are forked from the server, and look the function up in
+    their copy of the Dispatch, so only the binding's key, type, match,
+    ext and rest go over to them, and the result dict comes back (with
+    the body read into a string if it was a file or a generator). The
+    note is the one the worker's copy of the binding has. They are
+    started afresh whenever a binding made with this pool changes (or
+    the baseurl does), and the old ones are let go once they've
+    finished what they were doing; other bindings can come and go
+    without the workers noticing.
+
+    A worker that dies in the middle of a call (killed for using too
+    much memory, say) never answers, so these pools must have a
+    timeout, and a call gives up its place when it times out rather
+    than when it's done, which may be never.
+    """
+    kind = 'process'
+    release_on_timeout = True
+
+    def rebound(self):
+        self.stale = True
+
+    def make_pool(self):
+        return multiprocessing.Pool(self.workers, offload_worker_start,
+                                    (self.dispatch,))
+
+    def retire(self, pool, timeout=None):
+        pool.close()
+        # reaps the workers once they're done
+        t = threading.Thread(target=pool.join)
+        t.setDaemon(True)
+        t.start()
+        if timeout is not None:
+            t.join(timeout)
+            if t.isAlive():
+                pool.terminate()
+
+    def submit(self, finish, key, binding, type, match, ext, rest):
+        self.start().apply_async(offload_worker_call,
+                                 (key, type, match, ext, rest),
+                                 callback=finish)
+
+    def result(self, key, outcome):
+        ok, value = cPickle.loads(outcome)
+        if not ok:
+            raise RuntimeError('%s failed in process pool %s:\n%s'
+                               % (key, self.name, value))
+        return value
+
+
+class Bindings:
+    """
+    One unchanging snapshot of what Dispatch has bound: the bindings
+    dict, keyed by url, and the trie built from it. Dispatch swaps in a
+    whole new Bindings each time something is bound or unbound, and
+    never changes one once it's been handed out, so a request that
+    takes dispatch.table once sees the same bindings all the way
+    through without holding a lock.
+
+    The trie is only built the first time a lookup needs it, so a run
+    of bind() calls at startup doesn't build one per call.
+    """
+    def __init__(self, bindings=None):
+        self.bindings = bindings or {}
+        self.trie = None
+
+    def get_trie(self):
+        trie = self.trie
+        if trie is None:
+            # two threads may both build it; either one will do
+            trie = self.trie = self.build_trie()
+        return trie
+
+    def build_trie(self):
+        """
+        Turns the bindings into a tree of URL segments. Each node is a
+        dict that maps a segment to the next node down; a node where a
+        bound URL ends also holds that URL under the key None.
+
+          /foo/bar  ->  {'': {'foo': {'bar': {None: '/foo/bar'}}}}
+        """
+        trie = {}
+        for url in self.bindings:
+            node = trie
+            for segment in url.split('/'):
+                node = node.setdefault(segment, {})
+            node[None] = url
+        return trie
+
+
 class Dispatch:
     def __init__(self):
-        self.bindings = {}
+        self.table = Bindings()
+        self.bindings = self.table.bindings
+        self.writing = threading.Lock()
+        self.cache = None
+        self.responses = ResponseCache()
+        self.pools = {}
+        self.metrics = None
         self.default = None
         self.baseurl = ""
         pass
@@ -203,6 +1210,7 @@ class Dispatch:
         
         """
         self.baseurl = baseurl
+        self.invalidate()
 
     def get_baseurl(self):
         return self.baseurl
@@ -210,176 +1218,3460 @@ class Dispatch:
     def munge_url(self, url):
         return self.baseurl + url
 
-    def bind(self, url, method, note=None):
-        self.bindings[url] = {"method": method, "note": note}
+    def route_cache(self, size=1024, threadsafe=False):
+        """
+        Remembers what the last 'size' distinct paths resolved to, so
+        repeat requests for the same URL skip the lookup. Pass size=0
+        to turn it off again. Use threadsafe=True if requests are
+        handled on more than one thread; Server does that for you in
+        every mode but 'single'.
+        """
+        if not size:
+            self.cache = None
+        elif threadsafe:
+            self.cache = LockedRouteCache(size)
+        else:
+            self.cache = RouteCache(size)
 
-    def unbind(self, url):
-        try:
-            del self.bindings[url]
-        except:
-            pass
+    def response_cache(self, max_bytes=16 * 1024 * 1024):
+        """
+        Sets how much memory the results of bindings made with a
+        cache_ttl may take up. Starts out at 16MB.
+        """
+        self.responses = ResponseCache(max_bytes)
 
-    def call(self, url, type, data):
-        match = url.rsplit('?', 1)[0]  # Strip off ?baz=bop... stuff
-
-        while len(match) > 0:
-            if (match.split('/')[-1:][0].rpartition('.')[2] ==
-                match.split('/')[-1:][0]):
-                # no trailing .ext
-                match = match
-                ext = ''
-            else:
-                # trailing .ext
-                # Note: since the match = line changes match, it has to be
-                # the 2nd one below...
-                ext = '.' + match.rpartition('.')[2]
-                match = match.rpartition('.')[0]
-
-            if self.bindings.has_key(match):
-                if type != 'PUT':
-                    data = url[len(match + ext):]
-                return self.bindings[match]["method"](
-                    type=type,
-                    match=match,
-                    ext=ext,
-                    rest=data,
-                    note=self.bindings[match]["note"])
-            else:
-                match = match.rsplit('/', 1)[0]
-
-        if self.bindings.has_key("default"):
-            if type != 'PUT':
-                data = url
-            return self.bindings["default"]["method"](
-                type=type,
-                match='',
-                ext='',
-                rest=data,
-                note=self.bindings["default"]["note"])
+    def invalidate(self, pools=None):
+        """
+        Forgets everything derived from the bindings. pools names the
+        pools whose bindings changed; by default that's all of them.
+        """
+        if self.cache is not None:
+            self.cache.clear()
+        self.responses.clear()
+        for name, pool in self.pools.items():
+            if pools is None or name in pools:
+                pool.rebound()
 
-        return {'r': None, 'c': httplib.NOT_FOUND, 'h': None}
+    def pool(self, name, kind='thread', workers=4, max_pending=None,
+             timeout=None, retry_after=1):
+        """
+        Sets up a pool, called name, for bindings made with pool=name to
+        run in, rather than on the thread handling the request:
 
-        return {'r': None, 'c': httplib.NOT_FOUND, 'h': None}
+          kind         'thread' for a pool of threads, or 'process' for
+                       worker processes, for functions that would
+                       otherwise hog the GIL; see ProcessOffload
+          workers      threads or processes in the pool
+          max_pending  calls running or waiting at once; more than that
+                       get a 503 with a Retry-After of retry_after
+                       seconds. None for no limit
+          timeout      seconds to wait for a call before answering 504;
+                       None to wait as long as it takes, which only a
+                       thread pool allows (a process pool worker that
+                       dies never answers)
 
+        Replaces any pool that already had that name. Returns the pool.
+        """
+        kinds = {'thread': ThreadOffload, 'process': ProcessOffload}
+        if kind not in kinds:
+            raise ValueError('unknown pool kind: %r' % kind)
+        if kind == 'process' and timeout is None:
+            raise ValueError('a process pool needs a timeout')
+        old = self.pools.get(name)
+        pool = self.pools[name] = kinds[kind](name, self, workers,
+                                              max_pending, timeout,
+                                              retry_after)
+        pool.metrics = self.metrics
+        if old is not None:
+            old.stop()
+        return pool
 
-class MyHTTPRequestHandler(SocketServer.ThreadingMixIn,
-                           SimpleHTTPServer.SimpleHTTPRequestHandler):
-    """
-    Doc me.
-    """
+    def start_pools(self):
+        """Gets the pools' workers going before the first call needs them."""
+        for pool in self.pools.values():
+            pool.start()
 
-    def do_all(self, type):
-        global serial
-        serial += 1
-        r = {'r': None, 'c': httplib.OK, 'h': None}
+    def stop_pools(self, timeout=None):
+        for pool in self.pools.values():
+            pool.stop(timeout)
 
-        if Debug("httptime"):
-            start = time.time()
-            print "TIME:%d %s" % (serial, self.path[:25])
+    def bind(self, url, method, note=None, stream=False, cache_ttl=None,
+             pool=None):
+        """
+        Binds url to method, which gets called with note as its note
+        argument. With stream=True, a PUT, POST or DELETE passes the
+        method a RequestBody to read the request body from, as rest
+        (the usual rest is in its .rest attribute). Otherwise a PUT gets
+        the whole body as a string, and the body of anything else is
+        thrown away.
 
-        if Debug("http"):
-            print self.headers
-            print '   size', self.headers.get('Content-Length', '')
+        If the method always gives the same answer for the same match,
+        ext, rest and note, set cache_ttl to keep its GET results for
+        that many seconds; see ResponseCache.
 
-        # Dispatch to the right function
-        data = ''
-        if type == 'PUT':
-            self.send_response(httplib.CONTINUE,
-                               httplib.responses[httplib.CONTINUE])
-            try:
-                size = int(self.headers.get('Content-Length', ''))
-                data = self.rfile.read(size)
-            except:
-                data = ''
+        The method is called on the thread handling the request, unless
+        pool names a pool set up with pool(), in which case it runs
+        there. A RequestBody can't be handed to another thread or
+        process, so that's not for stream=True bindings.
 
-        result = self.dispatch.call(self.path, type, data)
+        Each call copies the table of bindings (see change()), so to
+        make a lot of them at once, bind_many() is cheaper.
+        """
+        self.bind_many([(url, method, note, stream, cache_ttl, pool)])
 
-        r.update(result)
-        if Debug("http"): print "do_all:  %s, %s" % (result, self.path[:25])
-        if Debug("httptime"):
-            print "TIME:%d %.3f" % (serial, time.time() - start)
+    def bind_many(self, bindings):
+        """
+        Makes a batch of bindings in one go. Each one is a tuple of
+        bind()'s arguments, (url, method, note, stream, cache_ttl, pool),
+        as far along as you need to go, or a dict of them by name:
 
-        # Maybe we should put this behavior on a switch. Right now, if the
-        # dispatcher was not able to handle the request, then we return None
-        # and let the default SimpleHTTPServer try to handle it.
+          server.dispatch.bind_many([("/a", a), ("/b", b, "note"),
+                                     {"url": "/c", "method": c,
+                                      "cache_ttl": 60}])
 
-        if r['c'] is httplib.NOT_FOUND:
-            return None  # Hand off to the "regular" SimpleHTTPServer
+        Requests in flight see either all of them or none of them, and
+        the table (and the trie, caches and pools that depend on it) is
+        only rebuilt once, however many there are. If any of them is no
+        good, none of them are made.
+        """
+        made = []
+        for args in bindings:
+            if isinstance(args, dict):
+                made.append(self.binding(**args))
+            else:
+                made.append(self.binding(*args))
+        self.change(made, ())
 
-        # Note that send_error is purely a convenience and may get in the way at some
-        # point. It sends back an HTML respose with the error info in it.
-        if r['c'] >= httplib.BAD_REQUEST:
-            self.send_error(r['c'], httplib.responses[r['c']])
-        else:
-            self.send_response(r['c'], httplib.responses[r['c']])
+    def binding(self, url, method, note=None, stream=False, cache_ttl=None,
+                pool=None):
+        if pool is not None:
+            if pool not in self.pools:
+                raise ValueError('no pool called %r' % pool)
+            if stream:
+                raise ValueError('stream=True bindings run inline')
+        return (url, {"method": method, "note": note, "stream": stream,
+                      "cache_ttl": cache_ttl, "pool": pool})
 
-        # HTTP 1.1 requires a Content-Length header, compute it and add to the headers
-        # This means that thekre will be at least one header
-        if r['r'] is not None:
-            cl = len(r['r'])
-        else:
-            cl = 0
+    def unbind(self, url):
+        self.unbind_many([url])
 
-        if r['h'] is None:
-            r['h'] = [('Content-Length', cl)]
-        else:
-            r['h'].append(('Content-Length', cl))
+    def unbind_many(self, urls):
+        """Unbinds all of urls at once. Ones that aren't bound are skipped."""
+        self.change((), urls)
 
-        # send the headers
-        for header in r['h']:
-            if Debug("http"): print "%s: %s" % header
-            self.send_header(header[0], header[1])
+    def change(self, bound, unbound):
+        """
+        Copies the current bindings, makes the changes to the copy and
+        swaps the copy in as the new table (its trie comes later, see
+        Bindings). Only the callers of bind()
+        and unbind() wait on each other here; requests carry on with
+        whichever table they picked up and never lock anything.
+        """
+        self.writing.acquire()
+        try:
+            bindings = self.table.bindings.copy()
+            # the pools that ran, or will run, a binding that changed
+            pools = set()
+            for url in unbound:
+                pools.add(bindings.pop(url, {}).get("pool"))
+            for url, binding in bound:
+                pools.add(bindings.get(url, {}).get("pool"))
+                pools.add(binding.get("pool"))
+                bindings[url] = binding
+            table = Bindings(bindings)
+            # one assignment, so it's atomic; self.bindings is just a
+            # convenience for code that only reads it
+            self.table = table
+            self.bindings = table.bindings
+            # after the swap, so a route worked out from the old table
+            # is turned away by the route cache's generation check
+            self.invalidate(pools)
+        finally:
+            self.writing.release()
 
-        self.end_headers()
+    def current(self):
+        """
+        Returns the route cache's generation (None with no cache) and
+        the current table, read in that order. change() swaps the table
+        before it bumps the generation, so a route worked out from a
+        table that has since been replaced is always turned away by
+        RouteCache.put().
+        """
+        cache = self.cache
+        generation = None
+        if cache is not None:
+            generation = cache.generation
+        return generation, self.table
 
-        if r['r'] is not None:
-            self.wfile.write(r['r'])
-            if Debug("http"):
-                print ''
-                if len(r['r']) < 512:
-                    print r['r']
-                else:
-                    print r['r'][:256]
-                    print '  ...'
-                    print r['r'][-256:]
-        print '-=-=-=\n\n'
+    def resolve(self, url, table=None, generation=None):
+        """
+        Finds the binding that url falls under, following the rules at
+        the top of this file, in one left to right pass over its
+        segments. Returns (match, end) where url[len(match):end] is the
+        ext and url[end:] is the rest, or None if nothing matched.
 
-        self.connection.close()
-        return True
+        If route_cache() is on, repeat paths are answered from there.
+        table is the Bindings to look in and generation what current()
+        gave with it; by default they're taken here. A route found in a
+        table that came without a generation isn't cached.
+        """
+        path = url.rsplit('?', 1)[0]  # Strip off ?baz=bop... stuff
+        cache = self.cache
+        if table is None:
+            generation, table = self.current()
+        if cache is None:
+            return self.walk(path, table)
 
-    def do_POST(self):
-        self.do_all("POST")
+        hit, route = cache.get(path)
+        if not hit:
+            route = self.walk(path, table)
+            if generation is not None:
+                cache.put(path, route, generation)
+        return route
 
-    def do_PUT(self):
-        self.do_all("PUT")
+    def walk(self, path, table=None):
+        """
+        At each segment of path, the segment minus any '.ext' is looked
+        up as the end of a binding, then the whole segment is followed
+        further down the tree. The deepest binding seen wins, which is
+        the same one the old backwards, one segment at a time search
+        found.
+        """
+        if table is None:
+            table = self.table
+        trie = table.get_trie()
 
-    def do_DELETE(self):
-        self.do_all("DELETE")
+        found = None
+        node = trie
+        end = -1
+        for segment in path.split('/'):
+            end += len(segment) + 1
+            # end is 0 only for the empty segment in front of a leading
+            # '/', which is never a match on its own
+            if end:
+                dot = segment.rfind('.')
+                if dot < 0:
+                    child = node.get(segment)
+                else:
+                    child = node.get(segment[:dot])
+                if child is not None and None in child:
+                    found = (child[None], end)
+            node = node.get(segment)
+            if node is None:
+                break
+        return found
+
+    def rest(self, binding, type, data, rest):
+        """What a binding gets as its rest argument."""
+        if isinstance(data, RequestBody):
+            if binding.get("stream") and type in ('PUT', 'POST', 'DELETE'):
+                data.rest = rest
+                return data
+            if type == 'PUT':
+                return data.read()
+        elif type == 'PUT':
+            return data
+        return rest
+
+    def lookup(self, url):
+        """
+        Returns (binding, match, ext, rest, table) for url, where binding
+        is the key in self.bindings that url falls under and table the
+        Bindings it was found in, or None if nothing (not even a
+        "default") catches it.
+        """
+        generation, table = self.current()
+        route = self.resolve(url, table, generation)
+
+        if route is not None:
+            match, end = route
+            return (match, match, url[len(match):end], url[end:], table)
+
+        if "default" in table.bindings:
+            return ("default", '', '', url, table)
+
+        return None
+
+    def invoke(self, found, type, data):
+        """
+        Calls the function for what lookup() found, as bound in the
+        table it was found in, so a bind() or unbind() in the meantime
+        doesn't change which function gets the call.
+        """
+        if found is not None:
+            key, match, ext, rest, table = found
+            binding = table.bindings.get(key)
+            if binding is not None:
+                if type == 'GET' and binding.get("cache_ttl"):
+                    call = lambda: self.run(key, binding, type, match, ext,
+                                            rest)
+                    # read before the table check: change() swaps the
+                    # table first and bumps the generation after, so a
+                    # result from a table that's been replaced never
+                    # gets stored
+                    generation = self.responses.generation
+                    if self.table is not table:
+                        return call()
+                    return self.responses.get(found[:4], binding["cache_ttl"],
+                                              call, generation)
+                return self.run(key, binding, type, match, ext,
+                                self.rest(binding, type, data, rest))
+
+        return {'r': None, 'c': httplib.NOT_FOUND, 'h': None}
+
+    def run(self, key, binding, type, match, ext, rest):
+        """Calls the function bound to key, in its pool if it has one."""
+        if binding.get("pool") is not None:
+            return self.pools[binding["pool"]].call(key, binding, type,
+                                                    match, ext, rest)
+        return binding["method"](type=type, match=match, ext=ext,
+                                 rest=rest, note=binding["note"])
+
+    def call(self, url, type, data):
+        return self.invoke(self.lookup(url), type, data)
+
+
+class Metrics:
+    """
+    Request counts by status code, bytes in and out, and a latency
+    histogram, for each binding (plus "(unbound)" for requests nothing
+    was bound to, like files served by the fallback).
+
+    Each thread records into its own set of counters, so recording a
+    request never waits on a lock; report() adds them all up when
+    someone asks. The histogram buckets double in size from half a
+    millisecond up to about 16 seconds.
+
+    Besides requests there are counters for things that happen to the
+    server as a whole, like load shedding (see count() and the list in
+    'help'), and gauges, which are functions asked for their value at
+    report time (see gauge()).
+
+    In 'fork' mode every worker process has its own Metrics, and each
+    scrape sees the process that happened to answer it.
+    """
+    buckets = [0.0005 * 2 ** i for i in range(16)]
+
+    help = {
+        'microhttpd_rejected_total':
+            'Connections and requests turned away with a 503, by reason.',
+        'microhttpd_timeouts_total':
+            'Connections dropped for being too slow, by what they were doing.',
+        'microhttpd_pool_timeouts_total':
+            'Calls a pool took too long over, and answered with a 504.',
+        'microhttpd_slow_subscribers_total':
+            'Event stream subscribers dropped for falling behind.',
+        'microhttpd_subscribers': 'Event stream subscribers connected.',
+        'microhttpd_connections': 'Connections open right now.',
+        'microhttpd_queue_depth': 'Connections or requests waiting for a worker.'}
+
+    def __init__(self):
+        self.local = threading.local()
+        self.shards = []
+        self.lock = threading.Lock()
+        self.events = {}
+        self.gauges = {}
+
+    def count(self, name, n=1, **labels):
+        """
+        Adds n to the counter name{labels}. These are for rare events, so
+        unlike record() it takes a lock.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.events[key] = self.events.get(key, 0) + n
+
+    def gauge(self, name, function):
+        """Reports function() as the gauge 'name' from now on."""
+        self.gauges[name] = function
+
+    def shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = {}
+            with self.lock:
+                self.shards.append(shard)
+            return shard
+
+    def record(self, route, code, bytes_in, bytes_out, seconds):
+        shard = self.shard()
+        stats = shard.get(route)
+        if stats is None:
+            # [codes, bytes in, bytes out, total seconds, histogram]
+            stats = shard[route] = [{}, 0, 0, 0.0,
+                                    [0] * (len(self.buckets) + 1)]
+        codes = stats[0]
+        codes[code] = codes.get(code, 0) + 1
+        stats[1] += bytes_in
+        stats[2] += bytes_out
+        stats[3] += seconds
+        stats[4][bisect.bisect_left(self.buckets, seconds)] += 1
+
+    def totals(self):
+        """All the shards added up: {route: [codes, in, out, seconds, histogram]}."""
+        with self.lock:
+            shards = list(self.shards)
+        totals = {}
+        for shard in shards:
+            for route, stats in shard.items():
+                total = totals.get(route)
+                if total is None:
+                    total = totals[route] = [{}, 0, 0, 0.0,
+                                             [0] * (len(self.buckets) + 1)]
+                for code, count in stats[0].items():
+                    total[0][code] = total[0].get(code, 0) + count
+                total[1] += stats[1]
+                total[2] += stats[2]
+                total[3] += stats[3]
+                for i, count in enumerate(stats[4]):
+                    total[4][i] += count
+        return totals
+
+    def report(self):
+        """Everything in the Prometheus text exposition format."""
+        totals = sorted(self.totals().items())
+        lines = [
+            '# HELP microhttpd_requests_total Requests answered.',
+            '# TYPE microhttpd_requests_total counter']
+        for route, stats in totals:
+            for code, count in sorted(stats[0].items()):
+                lines.append('microhttpd_requests_total{route=%s,code="%d"} %d'
+                             % (self.label(route), code, count))
+        lines += [
+            '# HELP microhttpd_request_bytes_total Request body bytes read.',
+            '# TYPE microhttpd_request_bytes_total counter']
+        for route, stats in totals:
+            lines.append('microhttpd_request_bytes_total{route=%s} %d'
+                         % (self.label(route), stats[1]))
+        lines += [
+            '# HELP microhttpd_response_bytes_total Response body bytes sent.',
+            '# TYPE microhttpd_response_bytes_total counter']
+        for route, stats in totals:
+            lines.append('microhttpd_response_bytes_total{route=%s} %d'
+                         % (self.label(route), stats[2]))
+        lines += [
+            '# HELP microhttpd_request_duration_seconds Time to answer a request.',
+            '# TYPE microhttpd_request_duration_seconds histogram']
+        for route, stats in totals:
+            route = self.label(route)
+            count = 0
+            for i, bound in enumerate(self.buckets):
+                count += stats[4][i]
+                lines.append(
+                    'microhttpd_request_duration_seconds_bucket{route=%s,le="%g"} %d'
+                    % (route, bound, count))
+            count += stats[4][-1]
+            lines.append(
+                'microhttpd_request_duration_seconds_bucket{route=%s,le="+Inf"} %d'
+                % (route, count))
+            lines.append('microhttpd_request_duration_seconds_sum{route=%s} %.6f'
+                         % (route, stats[3]))
+            lines.append('microhttpd_request_duration_seconds_count{route=%s} %d'
+                         % (route, count))
+
+        with self.lock:
+            events = sorted(self.events.items())
+        last = None
+        for (name, labels), count in events:
+            if name != last:
+                lines += self.describe(name, 'counter')
+                last = name
+            lines.append('%s{%s} %d' % (name, ','.join(
+                ['%s=%s' % (k, self.label(v)) for k, v in labels]), count))
+        for name, function in sorted(self.gauges.items()):
+            lines += self.describe(name, 'gauge')
+            lines.append('%s %d' % (name, function()))
+        return '\n'.join(lines) + '\n'
+
+    def describe(self, name, type):
+        lines = []
+        if name in self.help:
+            lines.append('# HELP %s %s' % (name, self.help[name]))
+        lines.append('# TYPE %s %s' % (name, type))
+        return lines
+
+    def label(self, route):
+        if route is None:
+            route = '(unbound)'
+        return '"%s"' % route.replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n')
+
+    def handler(self, type, match, ext, rest, note):
+        """
+        Bind this to serve the numbers, e.g.
+
+          server.dispatch.bind('/metrics', server.metrics.handler)
+        """
+        return {'h': [('Content-type', 'text/plain; version=0.0.4')],
+                'r': self.report()}
+
+
+class Profiler:
+    """
+    Profiles a random sample of the calls to each binding: 'rate' is the
+    fraction of calls to profile (0 to turn it off), and rates[route]
+    overrides it for one binding. Results pile up per binding until
+    reset() is called.
+
+    mode is either
+      'cprofile'  each sampled call runs under cProfile and the results
+                  are added into a pstats.Stats for its binding
+      'sample'    a background thread looks at the stacks of the threads
+                  running sampled calls every 'interval' seconds and
+                  counts them, giving collapsed stacks (the input format
+                  of flamegraph.pl); cheaper, and better at showing time
+                  spent blocked
+    At most max_stacks different stacks are kept per binding.
+
+    Bind handler to look at the results, and to change the rates while
+    the server is running.
+    """
+
+    def __init__(self, rate=0.0, mode='cprofile', interval=0.005,
+                 max_stacks=10000):
+        if mode not in ('cprofile', 'sample'):
+            raise ValueError('unknown profiler mode: %r' % mode)
+        self.rate = rate
+        self.rates = {}
+        self.mode = mode
+        self.interval = interval
+        self.max_stacks = max_stacks
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.stacks = {}
+        self.counts = {}
+        self.active = {}
+        self.wake = threading.Event()
+        self.sampler = None
+
+    def wanted(self, route):
+        rate = self.rates.get(route, self.rate)
+        return rate > 0 and random.random() < rate
+
+    def run(self, route, function, *args):
+        """Calls function(*args), profiled, and returns what it returns."""
+        with self.lock:
+            self.counts[route] = self.counts.get(route, 0) + 1
+        if self.mode == 'cprofile':
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(function, *args)
+            finally:
+                with self.lock:
+                    if route in self.stats:
+                        self.stats[route].add(profile)
+                    else:
+                        self.stats[route] = pstats.Stats(profile)
+
+        if self.sampler is None:
+            with self.lock:
+                if self.sampler is None:
+                    self.sampler = threading.Thread(target=self.sample)
+                    self.sampler.setDaemon(True)
+                    self.sampler.start()
+        me = threading.current_thread().ident
+        # register before waking the sampler, or it may find nothing to
+        # sample and go back to sleep while this request runs
+        self.active[me] = route
+        self.wake.set()
+        try:
+            return function(*args)
+        finally:
+            del self.active[me]
+
+    def sample(self):
+        top = Profiler.run.im_func.func_code
+        while True:
+            if not self.active:
+                self.wake.clear()
+                if not self.active:
+                    self.wake.wait()
+            frames = sys._current_frames()
+            for thread, route in self.active.items():
+                frame = frames.get(thread)
+                stack = []
+                while frame is not None and frame.f_code is not top:
+                    code = frame.f_code
+                    stack.append('%s (%s:%d)' % (code.co_name,
+                                                 os.path.basename(code.co_filename),
+                                                 code.co_firstlineno))
+                    frame = frame.f_back
+                if not stack:
+                    continue
+                stack.reverse()
+                stack = ';'.join(stack)
+                with self.lock:
+                    counts = self.stacks.setdefault(route, {})
+                    if stack in counts or len(counts) < self.max_stacks:
+                        counts[stack] = counts.get(stack, 0) + 1
+            del frames
+            time.sleep(self.interval)
+
+    def reset(self, route=None):
+        with self.lock:
+            if route is None:
+                self.stats = {}
+                self.stacks = {}
+                self.counts = {}
+            else:
+                self.stats.pop(route, None)
+                self.stacks.pop(route, None)
+                self.counts.pop(route, None)
+
+    def pstats_text(self, route, sort='cumulative', limit=50):
+        with self.lock:
+            stats = self.stats.get(route)
+            if stats is None:
+                return ''
+            out = StringIO.StringIO()
+            stats.stream = out
+            stats.sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+
+    def collapsed_text(self, route):
+        with self.lock:
+            counts = dict(self.stacks.get(route, {}))
+        return ''.join(['%s %d\n' % item for item in sorted(counts.items())])
+
+    def handler(self, type, match, ext, rest, note):
+        """
+        Bind this somewhere private, e.g.
+
+          server.dispatch.bind('/profile', server.profiler.handler)
+
+        and then:
+
+          /profile                       bindings with samples so far
+          /profile?route=/foo            pstats text for /foo
+          /profile?route=/foo&format=collapsed
+                                         collapsed stacks for /foo
+          /profile?route=/foo&sort=time&limit=20
+          /profile?rate=0.01             profile 1% of all calls
+          /profile?route=/foo&rate=0.5   profile half of the calls to /foo
+          /profile?reset=1[&route=/foo]  throw away what's been collected
+        """
+        query = urlparse.parse_qs(rest.partition('?')[2])
+        route = query.get('route', [None])[0]
+
+        if 'rate' in query:
+            try:
+                rate = float(query['rate'][0])
+            except ValueError:
+                return {'c': httplib.BAD_REQUEST}
+            if route is None:
+                self.rate = rate
+            else:
+                self.rates[route] = rate
+        if 'reset' in query:
+            self.reset(route)
+
+        if route is None:
+            with self.lock:
+                counts = sorted(self.counts.items())
+            text = 'mode %s, rate %g\n' % (self.mode, self.rate)
+            for route, count in counts:
+                text += '%s %d profiled (rate %g)\n' % (
+                    route, count, self.rates.get(route, self.rate))
+        elif query.get('format', [''])[0] == 'collapsed' or \
+             self.mode == 'sample':
+            text = self.collapsed_text(route)
+        else:
+            try:
+                limit = int(query.get('limit', ['50'])[0])
+            except ValueError:
+                return {'c': httplib.BAD_REQUEST}
+            text = self.pstats_text(route, query.get('sort',
+                                                     ['cumulative'])[0], limit)
+        return {'h': [('Content-type', 'text/plain')], 'r': text}
+
+
+class Batch:
+    """
+    Answers many requests in one: the body of a POST to handler is a
+    JSON list of sub-requests,
+
+      [["GET", "/foo/bar?x=1"], ["PUT", "/foo/baz", "new value"], ...]
+
+    each of them [method, url] or [method, url, body], and the answer is
+    a JSON list of what the bound functions returned, in the same order:
+
+      [{"c": 200, "h": [["Content-type", "text/plain"]], "r": "..."}, ...]
+
+    Sub-requests go straight to Dispatch.call(), so there's no network
+    hop and no static file fallback (unbound URLs get a 404). A body
+    that isn't UTF-8 text comes back base64 encoded, with "e": "base64"
+    in its result. Bodies that are files, iterators or generators are
+    read in, up to what's left of max_bytes; event streams, which may
+    never end, can't be batched, and get a 400 of their own.
+
+    With workers set, runs of GETs are spread over that many threads;
+    anything else waits for everything before it to finish, and
+    everything after it waits for it, so writes happen in the order
+    given. Limits:
+
+      max_requests  sub-requests in one batch, beyond that it's a 413
+      max_body      bytes in the batch request body, ditto
+      max_bytes     bytes of sub-response bodies in one answer; results
+                    that don't fit get a 507 of their own
+    """
+
+    def __init__(self, dispatch, workers=8, max_requests=50,
+                 max_body=1048576, max_bytes=4 * 1048576):
+        self.dispatch = dispatch
+        self.workers = workers
+        self.max_requests = max_requests
+        self.max_body = max_body
+        self.max_bytes = max_bytes
+        self.pool = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def workpool(self):
+        # started on first use, and again after a fork (the threads
+        # don't come along into the child)
+        with self.lock:
+            if self.pool is None or self.pid != os.getpid():
+                self.pool = WorkerPool(self.workers)
+                self.pid = os.getpid()
+            return self.pool
+
+    def parse(self, data):
+        """The sub-requests in data as (method, url, body) tuples."""
+        requests = json.loads(data)
+        if not isinstance(requests, list):
+            raise ValueError('a batch is a list of requests')
+        if len(requests) > self.max_requests:
+            raise OverflowError('more than %d requests in a batch'
+                                % self.max_requests)
+        parsed = []
+        for request in requests:
+            if not isinstance(request, list) or not 2 <= len(request) <= 3:
+                raise ValueError('not [method, url] or [method, url, body]: %r'
+                                 % (request,))
+            method, url = request[:2]
+            body = request[2] if len(request) == 3 else None
+            if not isinstance(method, basestring) or \
+               not isinstance(url, basestring) or \
+               not (body is None or isinstance(body, basestring)):
+                raise ValueError('method, url and body must be strings: %r'
+                                 % (request,))
+            if isinstance(body, unicode):
+                body = body.encode('utf-8')
+            parsed.append((str(method).upper(), str(url), body or ''))
+        return parsed
+
+    def call(self, method, url, body):
+        """One sub-request, turned into a result dict."""
+        found = self.dispatch.lookup(url)
+        if found is not None and found[4].bindings.get(
+                found[0], {}).get('method') == self.handler:
+            # a batch inside a batch could tie up every worker waiting
+            return {'c': httplib.BAD_REQUEST, 'r': 'batches do not nest'}
+        data = RequestBody(StringIO.StringIO(body), len(body))
+        try:
+            result = self.dispatch.invoke(found, method, data)
+        except BodyError, e:
+            return {'c': e.code, 'r': str(e)}
+        except Exception:
+            DebugMessage('batch request %s %s failed:\n%s'
+                         % (method, url, traceback.format_exc()), 'ERROR')
+            return {'c': httplib.INTERNAL_SERVER_ERROR}
+        return result
+
+    def run(self, requests):
+        """Results for requests, in order."""
+        results = [None] * len(requests)
+        pool = None
+        if self.workers:
+            pool = self.workpool()
+        i = 0
+        while i < len(requests):
+            j = i + 1
+            if pool is not None and requests[i][0] == 'GET':
+                while j < len(requests) and requests[j][0] == 'GET':
+                    j += 1
+            if j - i == 1:
+                results[i] = self.call(*requests[i])
+            else:
+                done = Queue.Queue()
+
+                def job(k):
+                    try:
+                        results[k] = self.call(*requests[k])
+                    finally:
+                        done.put(k)
+
+                for k in range(i + 1, j):
+                    pool.submit(job, k)
+                job(i)
+                for k in range(i, j):
+                    done.get()
+            i = j
+        return results
+
+    def encode(self, result, budget):
+        """
+        A JSON-able version of one result, and the body bytes it took
+        out of budget.
+        """
+        code = result.get('c') or httplib.OK
+        body = result.get('r')
+        headers = [[name, value] for name, value in result.get('h') or []]
+        if body is not None and not isinstance(body, basestring):
+            close = getattr(body, 'close', None)
+            try:
+                if event_stream(headers):
+                    return ({'c': httplib.BAD_REQUEST, 'h': [],
+                             'r': 'event streams are not batched'}, 0)
+                if hasattr(body, 'read'):
+                    body = body.read(budget + 1)
+                else:
+                    body = self.collect(body, budget + 1)
+            finally:
+                if close is not None:
+                    close()
+        size = len(body or '')
+        if size > budget:
+            return ({'c': httplib.INSUFFICIENT_STORAGE, 'h': [],
+                     'r': 'batch response over %d bytes' % self.max_bytes}, 0)
+        encoded = {'c': code, 'h': headers, 'r': body}
+        if isinstance(body, str):
+            try:
+                body.decode('utf-8')
+            except UnicodeDecodeError:
+                encoded['r'] = body.encode('base64').replace('\n', '')
+                encoded['e'] = 'base64'
+        return (encoded, size)
+
+    def collect(self, pieces, limit):
+        """
+        The pieces of an iterator body joined up, stopping once there
+        are at least limit bytes so that a long one isn't read to the end.
+        """
+        parts = []
+        size = 0
+        for piece in pieces:
+            if isinstance(piece, unicode):
+                piece = piece.encode('utf-8')
+            parts.append(piece)
+            size += len(piece)
+            if size >= limit:
+                break
+        return ''.join(parts)
+
+    def handler(self, type, match, ext, rest, note):
+        """
+        Bind this, with stream=True, to take batches, e.g.
+
+          server.dispatch.bind('/batch', batch.handler, stream=True)
+
+        or let Server.batch() do it.
+        """
+        if type != 'POST':
+            return {'c': httplib.METHOD_NOT_ALLOWED, 'h': [('Allow', 'POST')],
+                    'r': 'batches are POSTed\n'}
+        if not isinstance(rest, RequestBody):
+            return {'c': httplib.INTERNAL_SERVER_ERROR,
+                    'r': 'the batch binding needs stream=True\n'}
+        data = rest.read(self.max_body + 1)
+        if len(data) > self.max_body:
+            return {'c': httplib.REQUEST_ENTITY_TOO_LARGE,
+                    'r': 'batch over %d bytes\n' % self.max_body}
+        try:
+            requests = self.parse(data)
+        except OverflowError, e:
+            return {'c': httplib.REQUEST_ENTITY_TOO_LARGE, 'r': '%s\n' % e}
+        except ValueError, e:
+            return {'c': httplib.BAD_REQUEST, 'r': 'bad batch: %s\n' % e}
+
+        budget = self.max_bytes
+        encoded = []
+        for result in self.run(requests):
+            result, size = self.encode(result, budget)
+            budget -= size
+            encoded.append(result)
+        return {'h': [('Content-type', 'application/json')],
+                'r': json.dumps(encoded)}
+
+
+def event_frame(data, event=None, id=None):
+    """
+    One Server-Sent Event, as it goes out on a text/event-stream: data
+    (a string, which may have line breaks in it) with an optional event
+    type and id.
+    """
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    lines = []
+    if id is not None:
+        lines.append('id: %s' % id)
+    if event is not None:
+        lines.append('event: %s' % event)
+    for line in data.replace('\r\n', '\n').replace('\r', '\n').split('\n'):
+        lines.append('data: ' + line)
+    return '\n'.join(lines) + '\n\n'
+
+
+def event_stream(headers):
+    """Whether headers are those of a text/event-stream response."""
+    for name, value in headers or ():
+        if name.lower() == 'content-type':
+            return value.split(';', 1)[0].strip().lower() == \
+                'text/event-stream'
+    return False
+
+
+class Subscriber:
+    """
+    One client of an EventHub: the events published to its channels
+    wait here until its response gets round to sending them. Iterating
+    over it gives text/event-stream frames, until it is closed; it's
+    only subscribed while that's going on, so a response that never
+    gets sent doesn't leave it behind.
+    """
+
+    def __init__(self, hub, channels, max_pending):
+        self.hub = hub
+        self.channels = channels
+        self.max_pending = max_pending
+        self.frames = collections.deque()
+        self.wake = threading.Condition(threading.Lock())
+        self.closed = False
+        self.evicted = False
+
+    def offer(self, frame):
+        """Queues frame, or returns False if it's got too far behind."""
+        with self.wake:
+            if self.closed:
+                return True
+            if len(self.frames) >= self.max_pending:
+                self.closed = self.evicted = True
+                self.wake.notify()
+                return False
+            self.frames.append(frame)
+            self.wake.notify()
+        return True
+
+    def beat(self):
+        """Queues a comment, so an idle stream still sends something."""
+        with self.wake:
+            if not self.frames:
+                self.frames.append(':\n\n')
+                self.wake.notify()
+
+    def close(self):
+        with self.wake:
+            self.closed = True
+            self.wake.notify()
+
+    def __iter__(self):
+        self.hub.add(self)
+        try:
+            yield 'retry: %d\n\n' % (self.hub.retry * 1000)
+            while True:
+                with self.wake:
+                    while not self.frames and not self.closed:
+                        # no timeout, which would mean polling: the
+                        # hub's heartbeat wakes us up often enough
+                        self.wake.wait()
+                    if self.closed:
+                        return
+                    frames = list(self.frames)
+                    self.frames.clear()
+                yield ''.join(frames)
+        finally:
+            self.hub.remove(self)
+
+
+class EventHub:
+    """
+    Pushes events to clients as they happen, with Server-Sent Events,
+    instead of the clients polling for them. Bind handler (or have a
+    bound function return stream()) and a client that GETs it stays
+    connected, and is sent whatever publish() is given for the channels
+    it subscribed to.
+
+    Each subscriber has room for max_pending events that haven't been
+    sent yet. One that falls further behind than that is dropped, and
+    its response ends; browsers then reconnect after 'retry' seconds.
+    A comment goes out on every stream every 'heartbeat' seconds, so
+    idle connections aren't taken for dead by proxies or the timeouts
+    in Server.limits(), and clients that went away are noticed.
+
+    Every subscriber holds on to a worker thread while it's connected,
+    so allow for them in the number of workers. A client that stops
+    reading altogether only lets go of its thread when the send times
+    out, so set a write_timeout (see Server.limits()). In 'fork' mode every
+    worker process has its own subscribers, and publish() only reaches
+    the ones connected to the process it's called in. 'single' mode has
+    no thread to spare at all, so there (single is set) stream() answers
+    503 instead. Nor can a stream come from a binding made with a
+    process pool, since the pool would have to read it to the end.
+    """
+    single = False
+
+    def __init__(self, max_pending=100, heartbeat=15, retry=3):
+        self.max_pending = max_pending
+        self.heartbeat = heartbeat
+        self.retry = retry
+        self.channels = {}
+        self.lock = threading.Lock()
+        self.beating = None
+        self.closing = False
+        self.metrics = None
+
+    def subscribe(self, channels):
+        """A new Subscriber to channels, which starts listening when iterated."""
+        return Subscriber(self, list(channels), self.max_pending)
+
+    def add(self, subscriber):
+        with self.lock:
+            if self.closing:
+                subscriber.closed = True
+                return
+            for channel in subscriber.channels:
+                self.channels.setdefault(channel, set()).add(subscriber)
+            if self.beating != os.getpid():
+                # started here, and again in a process forked off later
+                self.beating = os.getpid()
+                t = threading.Thread(target=self.beat)
+                t.setDaemon(True)
+                t.start()
+
+    def remove(self, subscriber):
+        with self.lock:
+            for channel in subscriber.channels:
+                subscribers = self.channels.get(channel)
+                if subscribers is not None:
+                    subscribers.discard(subscriber)
+                    if not subscribers:
+                        del self.channels[channel]
+
+    def publish(self, channel, data, event=None, id=None):
+        """
+        Sends data as an event to everyone subscribed to channel, and
+        returns how many that is. See event_frame().
+        """
+        frame = event_frame(data, event, id)
+        with self.lock:
+            subscribers = list(self.channels.get(channel, ()))
+        evicted = 0
+        for subscriber in subscribers:
+            if not subscriber.offer(frame):
+                self.remove(subscriber)
+                evicted += 1
+        if evicted and self.metrics is not None:
+            self.metrics.count('microhttpd_slow_subscribers_total', evicted)
+        return len(subscribers) - evicted
+
+    def beat(self):
+        while True:
+            time.sleep(self.heartbeat)
+            for subscriber in self.subscribers():
+                subscriber.beat()
+
+    def subscribers(self):
+        with self.lock:
+            everyone = set()
+            for subscribers in self.channels.values():
+                everyone.update(subscribers)
+        return everyone
+
+    def count(self):
+        return len(self.subscribers())
+
+    def close(self):
+        """Ends every stream, and any started later; see Server.shutdown()."""
+        self.closing = True
+        for subscriber in self.subscribers():
+            subscriber.close()
+
+    def stream(self, channels):
+        """The response for a bound function to return to subscribe to channels."""
+        if self.single:
+            # the one serving thread would be tied up until shutdown
+            return {'c': httplib.SERVICE_UNAVAILABLE,
+                    'h': [('Content-type', 'text/plain')],
+                    'r': 'event streams need a concurrency mode other '
+                         'than single\n'}
+        return {'h': [('Content-type', 'text/event-stream'),
+                      ('Cache-Control', 'no-cache'),
+                      ('X-Accel-Buffering', 'no')],
+                'r': iter(self.subscribe(channels))}
+
+    def handler(self, type, match, ext, rest, note):
+        """
+        Bind this to let clients subscribe, e.g.
+
+          server.dispatch.bind('/events', server.events.handler)
+
+        and then GET /events?channel=prices&channel=news
+        """
+        if type != 'GET':
+            return {'c': httplib.METHOD_NOT_ALLOWED, 'h': [('Allow', 'GET')],
+                    'r': 'subscribe with a GET\n'}
+        channels = urlparse.parse_qs(rest.partition('?')[2]).get('channel')
+        if not channels:
+            return {'c': httplib.BAD_REQUEST, 'r': 'no channel given\n'}
+        return self.stream(channels)
+
+
+class AccessLog:
+    """
+    One record per request: time, client, method, path, the binding that
+    handled it, status, bytes sent, duration and serial number. 'format'
+    is "common" (Common Log Format with route, duration and serial tacked
+    on the end) or "json" (one JSON object per line).
+
+    Records collect in a buffer that is written out when it passes
+    flush_size bytes, and at least every 'interval' seconds by a
+    background thread, so requests don't each wait on a write. The
+    thread is started by the first record each process logs, since
+    threads don't survive into the workers that 'fork' mode forks off.
+    """
+
+    def __init__(self, stream, format='common', flush_size=65536,
+                 interval=1.0):
+        if format not in ('common', 'json'):
+            raise ValueError('unknown access log format: %r' % format)
+        self.stream = stream
+        self.format = format
+        self.flush_size = flush_size
+        self.interval = interval
+        self.buffer = []
+        self.size = 0
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.stamp_second = None
+        self.stamp = None
+        self.pid = None
+
+    def start(self):
+        """Starts flushing every 'interval' seconds in this process."""
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            if self.pid is not None:
+                # forked; what the parent had buffered is its to write
+                self.buffer, self.size = [], 0
+            self.pid = os.getpid()
+        if self.interval:
+            t = threading.Thread(target=self.flush_regularly)
+            t.setDaemon(True)
+            t.start()
+
+    def timestamp(self, when):
+        second = int(when)
+        if second != self.stamp_second:
+            self.stamp = time.strftime('%d/%b/%Y:%H:%M:%S +0000',
+                                       time.gmtime(second))
+            self.stamp_second = second
+        return self.stamp
+
+    def log(self, when, client, method, path, version, route, status,
+            size, duration, serial):
+        if self.format == 'json':
+            line = json.dumps({'time': when, 'client': client,
+                               'method': method, 'path': path,
+                               'version': version, 'route': route,
+                               'status': status, 'bytes': size,
+                               'duration': round(duration, 6),
+                               'serial': serial}) + '\n'
+        else:
+            line = '%s - - [%s] "%s %s %s" %d %d %s %.6f %d\n' % (
+                client, self.timestamp(when), method, path, version,
+                status, size, route is None and '-' or route, duration,
+                serial)
+        if self.pid != os.getpid():
+            self.start()
+        with self.lock:
+            self.buffer.append(line)
+            self.size += len(line)
+            full = self.size >= self.flush_size
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            lines, self.buffer, self.size = self.buffer, [], 0
+        if lines:
+            # Separate lock, so requests can keep adding to the buffer
+            # while this is stuck writing.
+            with self.write_lock:
+                self.stream.write(''.join(lines))
+                self.stream.flush()
+
+    def flush_regularly(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except (IOError, OSError, ValueError):
+                pass
+
+
+class Compression:
+    """
+    gzip/deflate for responses, when the client's Accept-Encoding allows
+    it. Only bodies of compressible types (text, JSON, XML, JavaScript)
+    and at least min_size bytes are compressed, at zlib level 'level'.
+
+    With cache_size set, the compressed form of the last cache_size
+    distinct (route, coding, body) combinations is kept, keyed on an MD5
+    of the body, so a binding that keeps returning the same text only
+    pays for compressing it once.
+
+    With static_gz set, the static fallback sends foo.gz, if there is
+    one, to clients that ask for foo and accept gzip.
+    """
+    types = ('text/', 'application/json', 'application/javascript',
+             'application/xml', '+json', '+xml')
+    # compressing these would hold each piece back until there's enough
+    never = ('text/event-stream',)
+
+    def __init__(self, level=6, min_size=1024, cache_size=0, static_gz=True):
+        self.level = level
+        self.min_size = min_size
+        self.cache_size = cache_size
+        self.static_gz = static_gz
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def acceptable(self, accept):
+        """The codings we know that an Accept-Encoding header allows, best first."""
+        codings = {}
+        for item in accept.split(','):
+            coding, semi, params = item.partition(';')
+            coding = coding.strip().lower()
+            q = 1.0
+            name, equals, value = params.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+            if coding == 'x-gzip':
+                coding = 'gzip'
+            if coding == '*':
+                codings.setdefault('gzip', q)
+                codings.setdefault('deflate', q)
+            elif coding in ('gzip', 'deflate'):
+                codings[coding] = q
+        # best q first, gzip ahead of deflate on a tie
+        return [c for q, i, c in sorted([(-codings.get(c, 0), i, c)
+                                         for i, c in enumerate(
+                                             ('gzip', 'deflate'))])
+                if q < 0]
+
+    def choose(self, accept):
+        """The coding to use for a client sending this Accept-Encoding, or None."""
+        codings = self.acceptable(accept)
+        return codings and codings[0] or None
+
+    def compressible(self, ctype):
+        ctype = ctype.split(';', 1)[0].strip().lower()
+        if ctype in self.never:
+            return False
+        for t in self.types:
+            if ctype.startswith(t) or ctype.endswith(t):
+                return True
+        return False
+
+    def compressor(self, coding):
+        if coding == 'gzip':
+            return zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        return zlib.compressobj(self.level)
+
+    def compress(self, route, coding, body):
+        if not self.cache_size:
+            z = self.compressor(coding)
+            return z.compress(body) + z.flush()
+
+        key = (route, coding, hashlib.md5(body).digest())
+        with self.lock:
+            data = self.cache.pop(key, None)
+            if data is not None:
+                self.cache[key] = data
+                self.hits += 1
+                return data
+            self.misses += 1
+        z = self.compressor(coding)
+        data = z.compress(body) + z.flush()
+        with self.lock:
+            self.cache[key] = data
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return data
+
+    def stream(self, pieces, coding, source=None):
+        """
+        Compresses an iterable of strings as it goes, flushing after each
+        piece so that nothing sits in the compressor waiting for more.
+        source is what pieces reads from, if that is something else (a
+        file read in blocks, say); it is closed along with pieces.
+        """
+        z = self.compressor(coding)
+        try:
+            for piece in pieces:
+                if piece:
+                    yield z.compress(piece) + z.flush(zlib.Z_SYNC_FLUSH)
+            yield z.flush()
+        finally:
+            for thing in (pieces, source):
+                close = getattr(thing, 'close', None)
+                if close is not None:
+                    close()
+
+
+def overloaded(retry_after):
+    """The 503 for a connection we turn away without reading its request."""
+    return ('HTTP/1.1 503 Service Unavailable\r\nRetry-After: %d\r\n'
+            'Content-Length: 0\r\nConnection: close\r\n\r\n' % retry_after)
+
+
+class ThreadPoolMixIn:
+    """
+    Mix-in for SocketServer.TCPServer that hands each accepted
+    connection to a fixed pool of worker threads instead of handling it
+    in the accept loop.
+
+    Connections wait in a bounded queue of queue_size entries. When the
+    queue is full, a new connection gets a 503 with a Retry-After of
+    retry_after seconds straight away, so clients of an overloaded
+    server hear about it quickly instead of all of them waiting longer
+    and longer. With shed off, the accept loop blocks until a worker
+    frees up instead, and the burst backs up into the listen backlog.
+
+    Once max_connections connections (if set) are being served or
+    queued, new ones get the same 503. That needs 'connections', a
+    ConnectionTracker that the handlers keep up to date.
+    """
+    workers = 8
+    queue_size = 64
+    shed = True
+    max_connections = None
+    retry_after = 1
+    connections = None
+    metrics = None
+
+    def start_workers(self):
+        self.pending = Queue.Queue(self.queue_size)
+        self.threads = []
+        for i in range(self.workers):
+            t = threading.Thread(target=self.process_pending)
+            t.setDaemon(True)
+            t.start()
+            self.threads.append(t)
+
+    def process_pending(self):
+        while True:
+            request, client_address = self.pending.get()
+            if request is None:
+                return
+            try:
+                self.finish_request(request, client_address)
+            except:
+                self.handle_error(request, client_address)
+            self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        if self.max_connections and self.connections is not None and \
+           self.connections.count() + self.pending.qsize() >= \
+           self.max_connections:
+            self.reject(request, 'connections')
+        elif not self.shed:
+            self.pending.put((request, client_address))
+        else:
+            try:
+                self.pending.put_nowait((request, client_address))
+            except Queue.Full:
+                self.reject(request, 'queue')
+
+    def reject(self, request, reason):
+        try:
+            request.setblocking(0)
+            request.send(overloaded(self.retry_after))
+            # Closing with unread data in the socket makes a reset that
+            # can beat the 503 to the client, so read what's there.
+            request.recv(65536)
+        except socket.error:
+            pass
+        self.shutdown_request(request)
+        if self.metrics is not None:
+            self.metrics.count('microhttpd_rejected_total', reason=reason)
+
+    def stop_workers(self, timeout=None):
+        """
+        Tells the workers to quit once the connections already queued
+        are handled. With a timeout, waits up to that many seconds for
+        them to get there.
+        """
+        if timeout is None:
+            for t in self.threads:
+                self.pending.put((None, None))
+            return
+        deadline = time.time() + timeout
+        try:
+            for t in self.threads:
+                self.pending.put((None, None), True,
+                                 max(deadline - time.time(), 0))
+        except Queue.Full:
+            return
+        for t in self.threads:
+            t.join(max(deadline - time.time(), 0))
+
+
+class ThreadPoolHTTPServer(ThreadPoolMixIn, BaseHTTPServer.HTTPServer):
+    pass
+
+
+class ConnectionTracker:
+    """
+    The connections a server has open, and whether each one is in the
+    middle of a request, so that a graceful shutdown knows what it has
+    to wait for and which connections it can just hang up on.
+
+    A handler can also set a deadline for reading its request, and
+    expire() hangs up on the ones that miss it. The socket timeout can't
+    do that, since a client that sends a byte now and then never lets it
+    run out.
+    """
+
+    def __init__(self):
+        self.busy = {}
+        self.deadlines = {}
+        self.lock = threading.Condition()
+
+    def count(self):
+        return len(self.busy)
+
+    def deadline(self, sock, when, handler=None):
+        """
+        Hang up on sock at time 'when' if handler.reading() still says
+        it's reading its request then. when=None clears it.
+        """
+        with self.lock:
+            if when is None:
+                self.deadlines.pop(sock, None)
+            elif sock in self.busy:
+                self.deadlines[sock] = (when, handler)
+
+    def expire(self):
+        """Hangs up on the connections past their deadline. Returns how many."""
+        now = time.time()
+        with self.lock:
+            late = [sock for sock, (when, handler) in self.deadlines.items()
+                    if when < now and handler.reading()]
+            for sock in late:
+                del self.deadlines[sock]
+        for sock in late:
+            try:
+                # only the reading side, so the handler can still say 408
+                sock.shutdown(socket.SHUT_RD)
+            except socket.error:
+                pass
+        return len(late)
+
+    def opened(self, sock):
+        with self.lock:
+            self.busy[sock] = False
+
+    def working(self, sock, busy):
+        with self.lock:
+            if sock in self.busy:
+                self.busy[sock] = busy
+
+    def closed(self, sock):
+        with self.lock:
+            self.busy.pop(sock, None)
+            self.deadlines.pop(sock, None)
+            self.lock.notifyAll()
+
+    def hang_up(self, idle_only=True):
+        """
+        Shuts down the idle connections (or all of them), so a handler
+        waiting for the next request on one sees end of file.
+        """
+        with self.lock:
+            socks = [sock for sock, busy in self.busy.items()
+                     if not (busy and idle_only)]
+        for sock in socks:
+            try:
+                sock.shutdown(idle_only and socket.SHUT_RD or
+                              socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def drain(self, deadline):
+        """
+        Waits until every connection is closed or deadline passes,
+        hanging up on connections as they go idle, then hangs up on
+        whatever is left. Returns how many that was.
+        """
+        while True:
+            self.hang_up()
+            with self.lock:
+                left = len(self.busy)
+                if not left or time.time() >= deadline:
+                    break
+                self.lock.wait(min(0.1, max(deadline - time.time(), 0)))
+        if left:
+            self.hang_up(idle_only=False)
+        return left
+
+
+class OpenFile:
+    """
+    A file kept open by FileCache, along with what we need to know
+    about it to answer a request: size, mtime and an ETag.
+    """
+
+    def __init__(self, path, st):
+        self.fd = os.open(path, os.O_RDONLY)
+        self.size = st.st_size
+        self.mtime = st.st_mtime
+        self.ino = st.st_ino
+        self.etag = '"%x-%x-%x"' % (st.st_ino, st.st_size,
+                                    int(st.st_mtime * 1000))
+        self.refs = 0
+        self.dropped = False
+        self.mapping = None
+
+    def same(self, st):
+        return (self.ino == st.st_ino and self.size == st.st_size and
+                self.mtime == st.st_mtime)
+
+    def map(self):
+        """The whole file as a read-only mmap, made the first time it's asked for."""
+        if self.mapping is None and self.size:
+            self.mapping = mmap.mmap(self.fd, self.size,
+                                     access=mmap.ACCESS_READ)
+        return self.mapping
+
+    def close(self):
+        if self.mapping is not None:
+            self.mapping.close()
+        os.close(self.fd)
+
+
+class FileCache:
+    """
+    Keeps the last 'size' files served by the static fallback open, so
+    hot files cost a stat() per request instead of an open() and close().
+    A file that changed on disk, or fell off the end of the list, is
+    closed once the last request using it calls release().
+    """
+
+    def __init__(self, size=64):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def acquire(self, path):
+        st = os.stat(path)
+        if not stat.S_ISREG(st.st_mode):
+            raise IOError(errno.ENOENT, 'not a regular file', path)
+        with self.lock:
+            f = self.entries.pop(path, None)
+            if f is not None and not f.same(st):
+                self.drop(f)
+                f = None
+            if f is None:
+                f = OpenFile(path, st)
+            self.entries[path] = f
+            while len(self.entries) > self.size:
+                self.drop(self.entries.popitem(last=False)[1])
+            f.refs += 1
+            return f
+
+    def release(self, f):
+        with self.lock:
+            f.refs -= 1
+            if f.dropped and f.refs == 0:
+                f.close()
+
+    def drop(self, f):
+        f.dropped = True
+        if f.refs == 0:
+            f.close()
+
+
+class MyHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    """
+    Doc me.
+
+    Connections are persistent (HTTP/1.1 keep-alive) unless the client
+    asks for 'Connection: close', the client is HTTP/1.0 and did not ask
+    for 'Connection: keep-alive', or one of the limits below is hit:
+
+      max_requests  requests answered on one connection before it is
+                    closed (0 means no limit)
+      timeout       seconds a connection may sit idle waiting for the
+                    next request before it is dropped
+
+    Pipelined requests are read from the buffered rfile and answered
+    one after another, in order.
+
+    Request bodies bigger than max_body bytes (if set) are refused with
+    a 413. An unread body of more than drain_limit bytes is not worth
+    reading just to throw away, so the connection is closed instead.
+
+    Once draining is set (see Server.shutdown) every connection is
+    closed after the response it is working on.
+
+    Slow clients (see Server.limits):
+
+      read_timeout   seconds a client gets to send a whole request, head
+                     and body, from the first byte of it (until then,
+                     the idle 'timeout' applies); it gets a 408 if it can still
+                     take one. None for no limit. Needs 'connections'.
+      write_timeout  seconds a send of the response may go without the
+                     client taking any of it (the socket timeout while
+                     writing); None to stick with 'timeout'
+
+    With lean set, requests are read by a parser of our own instead of
+    BaseHTTPServer's: the head is read in one go through a SocketReader
+    and the headers are a LazyHeaders, which only looks at a header when
+    it's asked for. A head over max_head bytes gets a 413, and one with
+    malformed header lines a 400.
+
+    With coalesce set, the wfile is a SocketWriter, which holds what's
+    written until the response is done (or there's a lot of it) and
+    sends it all at once; since that leaves nothing for Nagle's
+    algorithm to gather up, it's turned off (disable_nagle_algorithm).
+    The status lines, Server and Date headers are kept formatted rather
+    than put together for each response.
+    """
+    max_requests = 100
+    timeout = 15
+    read_timeout = None
+    write_timeout = None
+    retry_after = 1
+    lean = False
+    max_head = 65536
+    coalesce = True
+    disable_nagle_algorithm = True
+    status_lines = {}
+    server_line = None
+    date_line = (None, '')
+    stream_bufsize = 65536
+    max_body = None
+    drain_limit = 65536
+    metrics = None
+    compression = None
+    access_log = None
+    profiler = None
+    connections = None
+    draining = False
+    open_files = FileCache()
+
+    def setup(self):
+        SimpleHTTPServer.SimpleHTTPRequestHandler.setup(self)
+        self.requests_handled = 0
+        self.connection_header = None
+        self.body = None
+        self.read_deadline = None
+        self.started = None
+        if self.lean:
+            self.rfile = SocketReader(self.connection.recv)
+        if self.coalesce:
+            self.wfile = SocketWriter(self.connection.sendall)
+        if self.connections is not None:
+            self.connections.opened(self.connection)
+
+    def wait_for_request(self):
+        """
+        Waits, for up to the idle 'timeout', for the first byte of the
+        next request, and then starts read_timeout's clock on it. False
+        if the client hung up or never sent anything.
+        """
+        if not self.buffered():
+            try:
+                if not self.connection.recv(1, socket.MSG_PEEK):
+                    return False
+            except socket.timeout, e:
+                self.log_error("Request timed out: %r", e)
+                return False
+            except socket.error:
+                return False
+        self.read_deadline = time.time() + self.read_timeout
+        self.connections.deadline(self.connection, self.read_deadline, self)
+        return True
+
+    def buffered(self):
+        """Whether some of the next request has already been read in."""
+        if self.lean:
+            return bool(self.rfile.buf)
+        return bool(self.rfile._rbuf.getvalue())
+
+    def reading(self):
+        """True until the whole request, body and all, has been read."""
+        return self.body is None or not self.body.done
+
+    def overdue(self):
+        return self.read_deadline is not None and \
+            time.time() > self.read_deadline
+
+    def finish(self):
+        try:
+            SimpleHTTPServer.SimpleHTTPRequestHandler.finish(self)
+        finally:
+            if self.connections is not None:
+                self.connections.closed(self.connection)
+
+    def begin(self):
+        """Resets what we keep track of for each request."""
+        if self.connections is not None:
+            self.connections.working(self.connection, True)
+        self.connection_header = None
+        self.serial = next(serials)
+        self.started = time.time()
+        self.status = None
+        self.route = None
+        self.path = ''
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def parse_request(self):
+        self.begin()
+        if self.overdue():
+            # expire() cut it off, maybe before the end of the request
+            # line, which would then pass for an HTTP/0.9 request
+            self.command = None
+            self.request_version = self.protocol_version
+            self.requestline = self.raw_requestline.rstrip('\r\n')
+            self.close_connection = 1
+            self.send_error(httplib.REQUEST_TIMEOUT)
+            return False
+        if self.lean:
+            parsed = self.parse_lean()
+        else:
+            parsed = SimpleHTTPServer.SimpleHTTPRequestHandler.parse_request(
+                self)
+        if not parsed:
+            return False
+        self.requests_handled += 1
+        if self.overdue():
+            # expire() cut it off, so the headers are likely incomplete
+            self.close_connection = 1
+            self.send_error(httplib.REQUEST_TIMEOUT)
+            return False
+        return True
+
+    def parse_lean(self):
+        """
+        parse_request() for the lean parser, which has left the request
+        line in raw_requestline and the rest of the head in header_block.
+        """
+        self.command = None
+        self.request_version = version = self.default_request_version
+        self.close_connection = 1
+        self.requestline = requestline = self.raw_requestline.rstrip('\r')
+        words = requestline.split()
+        if len(words) != 3:
+            self.send_error(httplib.BAD_REQUEST,
+                            "Bad request syntax (%r)" % requestline)
+            return False
+        command, path, version = words
+        if version == 'HTTP/1.1':
+            if self.protocol_version >= "HTTP/1.1":
+                self.close_connection = 0
+        elif version != 'HTTP/1.0':
+            try:
+                if version[:5] != 'HTTP/':
+                    raise ValueError(version)
+                major, minor = [int(n) for n in version[5:].split('.')]
+            except ValueError:
+                self.send_error(httplib.BAD_REQUEST,
+                                "Bad request version (%r)" % version)
+                return False
+            if major >= 2:
+                self.send_error(httplib.HTTP_VERSION_NOT_SUPPORTED,
+                                "Invalid HTTP Version (%s)" % version[5:])
+                return False
+            if (major, minor) >= (1, 1) and \
+               self.protocol_version >= "HTTP/1.1":
+                self.close_connection = 0
+        self.command, self.path, self.request_version = command, path, version
+
+        block = self.header_block
+        if block[1:2] in (' ', '\t') or bad_header_line.search(block):
+            self.close_connection = 1
+            self.send_error(httplib.BAD_REQUEST, "Bad header line")
+            return False
+        self.headers = LazyHeaders(block)
+
+        conntype = self.headers.get('Connection', "").lower()
+        if conntype == 'close':
+            self.close_connection = 1
+        elif conntype == 'keep-alive' and self.protocol_version >= "HTTP/1.1":
+            self.close_connection = 0
+        return True
+
+    def handle_lean_request(self):
+        """
+        BaseHTTPRequestHandler.handle_one_request() for the lean parser,
+        which reads the whole head in one go.
+        """
+        try:
+            try:
+                head = self.rfile.read_head(self.max_head)
+            except BodyError, e:
+                self.requestline = ''
+                self.request_version = ''
+                self.command = ''
+                self.close_connection = 1
+                if self.overdue():
+                    self.send_error(httplib.REQUEST_TIMEOUT)
+                else:
+                    self.send_error(e.code, str(e))
+                return
+            if not head:
+                self.close_connection = 1
+                return
+            end = head.find('\n')
+            if end < 0:
+                end = len(head)
+            self.raw_requestline = head[:end]
+            self.header_block = head[end:]
+            if not self.parse_request():
+                return
+            mname = 'do_' + self.command
+            if not hasattr(self, mname):
+                self.send_error(httplib.NOT_IMPLEMENTED,
+                                "Unsupported method (%r)" % self.command)
+                return
+            getattr(self, mname)()
+            self.wfile.flush()
+        except socket.timeout, e:
+            self.log_error("Request timed out: %r", e)
+            self.close_connection = 1
+
+    def handle_one_request(self):
+        self.status = None
+        self.started = None
+        self.body = None
+        self.read_deadline = None
+        if self.read_timeout and self.connections is not None and \
+           not self.wait_for_request():
+            self.close_connection = 1
+            return
+        if self.lean:
+            self.handle_lean_request()
+        else:
+            SimpleHTTPServer.SimpleHTTPRequestHandler.handle_one_request(self)
+        # an error sent from parse_request() hasn't been flushed yet
+        self.wfile.flush()
+        if self.connections is not None:
+            self.connections.working(self.connection, False)
+            if not self.close_connection and \
+               self.write_timeout is not None:
+                self.connection.settimeout(self.timeout)
+        if self.draining:
+            self.close_connection = 1
+        if self.status is None:
+            return
+        duration = time.time() - self.started
+        if self.metrics is not None:
+            self.metrics.record(self.route, self.status, self.bytes_in,
+                                self.bytes_out, duration)
+        if self.access_log is not None:
+            self.access_log.log(self.started, self.client_address[0],
+                                self.command, self.path,
+                                self.request_version, self.route,
+                                self.status, self.bytes_out, duration,
+                                self.serial)
+
+    def log_error(self, format, *args):
+        # BaseHTTPServer says this when the socket timeout runs out
+        if format.startswith('Request timed out') and \
+           self.metrics is not None:
+            if self.status is not None:
+                kind = 'write'
+            elif self.started is not None:
+                kind = 'read'
+            else:
+                kind = 'idle'
+            self.metrics.count('microhttpd_timeouts_total', kind=kind)
+        SimpleHTTPServer.SimpleHTTPRequestHandler.log_error(self, format,
+                                                            *args)
+
+    def log_request(self, code='-', size='-'):
+        # With an access log, that's where requests get logged
+        if self.access_log is None:
+            SimpleHTTPServer.SimpleHTTPRequestHandler.log_request(self, code,
+                                                                  size)
+
+    def send_response(self, code, message=None):
+        if self.started is None:
+            # an error sent before parse_request() got going
+            self.begin()
+        self.status = code
+        if self.connections is not None:
+            if self.read_timeout:
+                self.connections.deadline(self.connection, None)
+            if self.write_timeout is not None:
+                self.connection.settimeout(self.write_timeout)
+        self.log_request(code)
+        if self.request_version != 'HTTP/0.9':
+            self.wfile.write(self.status_line(code, message) +
+                             self.server_header() + self.date_header())
+
+    def status_line(self, code, message):
+        """The status line for code, formatted once for the usual messages."""
+        key = (self.protocol_version, code, message)
+        line = self.status_lines.get(key)
+        if line is None:
+            usual = message is None or message == httplib.responses.get(code)
+            if message is None:
+                message = self.responses.get(code, ('',))[0]
+            line = "%s %d %s\r\n" % (self.protocol_version, code, message)
+            if usual:
+                self.status_lines[key] = line
+        return line
+
+    def server_header(self):
+        line = self.server_line
+        if line is None:
+            line = MyHTTPRequestHandler.server_line = \
+                'Server: %s\r\n' % self.version_string()
+        return line
+
+    def date_header(self):
+        """The Date header, formatted once a second."""
+        now = int(time.time())
+        second, line = self.date_line
+        if second != now:
+            line = 'Date: %s\r\n' % self.date_time_string(now)
+            MyHTTPRequestHandler.date_line = (now, line)
+        return line
+
+    def send_header(self, keyword, value):
+        if keyword.lower() == 'connection':
+            self.connection_header = value
+        SimpleHTTPServer.SimpleHTTPRequestHandler.send_header(self, keyword,
+                                                              value)
+
+    def end_headers(self):
+        # Every response, including the ones SimpleHTTPServer sends for
+        # files, goes through here, so this is where we tell the client
+        # whether the connection stays open.
+        if self.connection_header is None:
+            if self.close_connection or self.draining or (
+                    self.max_requests and
+                    self.requests_handled >= self.max_requests):
+                self.send_header('Connection', 'close')
+            elif self.request_version == 'HTTP/1.0':
+                self.send_header('Connection', 'keep-alive')
+        SimpleHTTPServer.SimpleHTTPRequestHandler.end_headers(self)
+
+    def send_continue(self):
+        """Sends an interim '100 Continue' if the client is waiting for one."""
+        if self.headers.get('Expect', '').lower() == '100-continue' and \
+           self.request_version != 'HTTP/1.0':
+            self.wfile.write("%s %d %s\r\n\r\n" %
+                             (self.protocol_version, httplib.CONTINUE,
+                              httplib.responses[httplib.CONTINUE]))
+            self.wfile.flush()
+
+    def request_body(self):
+        """
+        Sets up a RequestBody for the request, after checking it against
+        max_body, or sends an error and returns None.
+        """
+        length = 0
+        chunked = False
+        coding = self.headers.get('Transfer-Encoding', '').strip().lower()
+        if coding == 'chunked':
+            chunked = True
+        elif coding and coding != 'identity':
+            self.send_error(httplib.NOT_IMPLEMENTED,
+                            'Unsupported Transfer-Encoding %r' % coding)
+            return None
+        else:
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                if length < 0:
+                    raise ValueError(length)
+            except ValueError:
+                self.send_error(httplib.BAD_REQUEST, 'Bad Content-Length')
+                return None
+            if self.max_body and length > self.max_body:
+                self.send_error(httplib.REQUEST_ENTITY_TOO_LARGE)
+                return None
+
+        if chunked or length:
+            self.send_continue()
+        return RequestBody(self.rfile, length, chunked, self.max_body)
+
+    def do_all(self, type):
+        serial = self.serial
+
+        if DEBUG_HTTPTIME.on:
+            start = time.time()
+            print "TIME:%d %s" % (serial, self.path[:25])
+
+        if DEBUG_HTTP.on:
+            print self.headers
+            print '   size', self.headers.get('Content-Length', '')
+
+        data = self.body = self.request_body()
+        if data is None:
+            return True
+
+        # Dispatch to the right function
+        found = self.dispatch.lookup(self.path)
+        if found is not None:
+            self.route = found[0]
+        try:
+            profiler = self.profiler
+            if profiler is not None and found is not None and \
+               profiler.wanted(self.route):
+                result = profiler.run(self.route, self.dispatch.invoke,
+                                      found, type, data)
+            else:
+                result = self.dispatch.invoke(found, type, data)
+        except BodyError, e:
+            if self.overdue():
+                self.close_connection = 1
+                self.send_error(httplib.REQUEST_TIMEOUT)
+            else:
+                self.send_error(e.code, str(e))
+            return True
+        finally:
+            self.bytes_in = data.received
+
+        # Whatever of the body the function didn't read gets thrown away,
+        # so the next request on the connection starts in the right place.
+        if not data.drain(self.drain_limit):
+            self.close_connection = 1
+
+        if isinstance(result, Response):
+            code, body, headers = result.c, result.r, result.h
+            head = result.head
+        else:
+            code = result.get('c', httplib.OK)
+            body = result.get('r')
+            headers = result.get('h')
+            head = None
+        if DEBUG_HTTP.on: print "do_all:  %s, %s" % (result, self.path[:25])
+        if DEBUG_HTTPTIME.on:
+            print "TIME:%d %.3f" % (serial, time.time() - start)
+
+        # Maybe we should put this behavior on a switch. Right now, if the
+        # dispatcher was not able to handle the request, then we return None
+        # and let the default SimpleHTTPServer try to handle it.
+
+        if code == httplib.NOT_FOUND:
+            return None  # Hand off to the "regular" SimpleHTTPServer
+
+        # Note that send_error is purely a convenience and may get in the way at some
+        # point. It sends back an HTML respose with the error info in it.
+        # send_error writes a complete response of its own, so only use it
+        # when the function did not supply a body.
+        if code >= httplib.BAD_REQUEST and body is None:
+            self.send_error(code, httplib.responses[code])
+            return True
+
+        # A function (or the response cache) that sets an ETag gets
+        # conditional GETs answered for it.
+        if type == 'GET' and code == httplib.OK and headers:
+            for name, value in headers:
+                if name.lower() == 'etag' and self.not_modified(value, None):
+                    close = getattr(body, 'close', None)
+                    if close is not None:
+                        close()
+                    self.send_response(httplib.NOT_MODIFIED)
+                    self.send_header('ETag', value)
+                    self.end_headers()
+                    return True
+
+        self.send_response(code, httplib.responses[code])
+
+        # A frozen Response already has its headers as bytes, and only
+        # needs them worked out again if they're about to be compressed.
+        if head is not None and not DEBUG_HTTP.on and \
+           self.request_version != 'HTTP/0.9' and \
+           (self.compression is None or
+            not result.compressible(self.compression)):
+            self.wfile.write(head)
+            self.end_headers()
+            self.wfile.write(body)
+            self.bytes_out = len(body)
+            return True
+
+        # HTTP 1.1 requires a Content-Length header, or chunked encoding
+        # when we can't know the length up front. Work out which, and add
+        # it to a copy of the headers, so there will be at least one header
+        # and a list the function hangs on to doesn't grow on every call.
+        headers = list(headers or [])
+        if self.compression is not None and body is not None:
+            body = self.compress(body, headers, code)
+
+        if body is not None:
+            cl = self.body_length(body)
+        else:
+            cl = 0
+
+        chunked = False
+        if cl is not None:
+            headers.append(('Content-Length', cl))
+        elif self.request_version == 'HTTP/1.0':
+            # No chunked encoding in 1.0, so closing the connection is what
+            # marks the end of the body.
+            headers.append(('Connection', 'close'))
+        else:
+            headers.append(('Transfer-Encoding', 'chunked'))
+            chunked = True
+
+        # send the headers
+        for header in headers:
+            if DEBUG_HTTP.on: print "%s: %s" % header
+            self.send_header(header[0], header[1])
+
+        self.end_headers()
+
+        if body is not None and not isinstance(body, basestring):
+            self.bytes_out = self.send_stream(body, chunked)
+        elif body is not None:
+            self.wfile.write(body)
+            self.bytes_out = cl
+            if DEBUG_HTTP.on:
+                print ''
+                shown = result.get('r')
+                if len(shown) < 512:
+                    print shown
+                else:
+                    print shown[:256]
+                    print '  ...'
+                    print shown[-256:]
+        if DEBUG_HTTP.on:
+            print '-=-=-=\n\n'
+
+        return True
+
+    def compress(self, body, headers, code):
+        """
+        Returns body gzipped or deflated if the client accepts that and
+        it's worth doing, adding the headers that go with it to headers.
+        Bodies of unknown length are always worth it, and are compressed
+        as they stream out.
+        """
+        compression = self.compression
+        ctype = None
+        for name, value in headers:
+            name = name.lower()
+            if name == 'content-encoding':
+                return body
+            if name == 'content-type':
+                ctype = value
+        if ctype is None or code != httplib.OK or \
+           not compression.compressible(ctype):
+            return body
+        headers.append(('Vary', 'Accept-Encoding'))
+
+        cl = self.body_length(body)
+        if cl is not None and cl < compression.min_size:
+            return body
+        coding = compression.choose(self.headers.get('Accept-Encoding', ''))
+        if coding is None:
+            return body
+
+        headers.append(('Content-Encoding', coding))
+        # The compressed body is a different representation, so it needs
+        # a different ETag; not_modified() knows to look past the suffix.
+        for i, (name, value) in enumerate(headers):
+            if name.lower() == 'etag' and value.endswith('"'):
+                headers[i] = (name, value[:-1] + '-' + coding + '"')
+        if isinstance(body, basestring):
+            return compression.compress(self.route, coding, body)
+        if hasattr(body, 'read'):
+            f = body
+            return compression.stream(
+                iter(lambda: f.read(self.stream_bufsize), ''), coding, f)
+        return compression.stream(body, coding)
+
+    def body_length(self, body):
+        """
+        Length of a response body, if it can be known before sending it,
+        otherwise None. Strings and files (or anything else that can seek)
+        have a length, generators and pipes don't.
+        """
+        if isinstance(body, basestring):
+            return len(body)
+        if not hasattr(body, 'read'):
+            return None
+        try:
+            st = os.fstat(body.fileno())
+            if stat.S_ISREG(st.st_mode):
+                return st.st_size - body.tell()
+            return None
+        except (AttributeError, IOError, OSError, ValueError):
+            pass
+        try:
+            here = body.tell()
+            body.seek(0, 2)
+            end = body.tell()
+            body.seek(here)
+            return end - here
+        except (AttributeError, IOError, OSError, ValueError):
+            return None
+
+    def send_stream(self, body, chunked):
+        """
+        Sends a body that is a file-like object (read stream_bufsize
+        bytes at a time) or an iterable of strings (sent as they come),
+        as chunks if chunked is set. Each piece goes straight out on the
+        socket, so at most one piece is held in memory and a slow client
+        slows down the producer rather than piling data up here.
+        Returns the number of body bytes sent.
+        """
+        sent = 0
+        try:
+            if hasattr(body, 'read'):
+                size = self.stream_bufsize
+                pieces = iter(lambda: body.read(size), '')
+            else:
+                pieces = body
+            for piece in pieces:
+                if not piece:
+                    continue  # an empty chunk would end the body
+                if chunked:
+                    self.wfile.write('%x\r\n%s\r\n' % (len(piece), piece))
+                else:
+                    self.wfile.write(piece)
+                # each piece goes out as soon as it's made
+                self.wfile.flush()
+                sent += len(piece)
+            if chunked:
+                self.wfile.write('0\r\n\r\n')
+            return sent
+        except:
+            # The client can't tell where this body ends now
+            self.close_connection = 1
+            raise
+        finally:
+            close = getattr(body, 'close', None)
+            if close is not None:
+                close()
+
+    def do_POST(self):
+        if self.do_all("POST") is None:
+            self.send_error(httplib.NOT_FOUND)
+
+    def do_PUT(self):
+        if self.do_all("PUT") is None:
+            self.send_error(httplib.NOT_FOUND)
+
+    def do_DELETE(self):
+        if self.do_all("DELETE") is None:
+            self.send_error(httplib.NOT_FOUND)
 
     def do_GET(self):
         if self.do_all("GET") is None:
-            SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(self)
+            self.send_static()
+
+    def do_HEAD(self):
+        self.send_static(body=False)
+
+    def send_static(self, body=True):
+        """
+        The fallback when nothing is bound to a GET: serves files from
+        the current directory. Files go out with sendfile() when it's
+        available (from an mmap when it isn't), with ETag and
+        Last-Modified, answering conditional requests with 304 and a
+        single byte Range with 206. Directories are left to
+        SimpleHTTPServer, apart from their index.html and the redirect
+        to add a missing '/', which SimpleHTTPServer sends without a
+        Content-Length, leaving a keep-alive client waiting for more.
+        """
+        path = self.translate_path(self.path)
+        if os.path.isdir(path):
+            parts = urlparse.urlsplit(self.path)
+            if not parts.path.endswith('/'):
+                self.send_response(httplib.MOVED_PERMANENTLY)
+                self.send_header('Location', urlparse.urlunsplit(
+                    parts[:2] + (parts.path + '/',) + parts[3:]))
+                self.send_header('Content-Length', 0)
+                self.end_headers()
+                return
+            for index in ('index.html', 'index.htm'):
+                index = os.path.join(path, index)
+                if os.path.isfile(index):
+                    path = index
+                    break
+            else:
+                if body:
+                    SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(self)
+                else:
+                    SimpleHTTPServer.SimpleHTTPRequestHandler.do_HEAD(self)
+                return
+
+        ctype = self.guess_type(path)
+        headers = []
+        f = None
+        if self.compression is not None and self.compression.static_gz and \
+           os.path.isfile(path + '.gz'):
+            headers.append(('Vary', 'Accept-Encoding'))
+            if 'gzip' in self.compression.acceptable(
+                    self.headers.get('Accept-Encoding', '')):
+                try:
+                    f = self.open_files.acquire(path + '.gz')
+                    headers.append(('Content-Encoding', 'gzip'))
+                except (IOError, OSError):
+                    pass
+
+        try:
+            if f is None:
+                f = self.open_files.acquire(path)
+        except (IOError, OSError):
+            self.send_error(httplib.NOT_FOUND, "File not found")
+            return
+        try:
+            self.send_file(f, ctype, body, headers)
+        finally:
+            self.open_files.release(f)
+
+    def send_file(self, f, ctype, body, headers=()):
+        if self.not_modified(f.etag, f.mtime):
+            self.send_response(httplib.NOT_MODIFIED)
+            self.send_header('ETag', f.etag)
+            self.send_header('Last-Modified', self.date_time_string(f.mtime))
+            for header in headers:
+                self.send_header(header[0], header[1])
+            self.end_headers()
+            return
+
+        byte_range = self.byte_range(f.size, f.etag, f.mtime)
+        if byte_range is False:
+            self.send_response(httplib.REQUESTED_RANGE_NOT_SATISFIABLE)
+            self.send_header('Content-Range', 'bytes */%d' % f.size)
+            self.send_header('Content-Length', 0)
+            self.end_headers()
+            return
+
+        if byte_range is None:
+            start, end = 0, f.size
+            self.send_response(httplib.OK)
+        else:
+            start, end = byte_range
+            self.send_response(httplib.PARTIAL_CONTENT)
+            self.send_header('Content-Range',
+                             'bytes %d-%d/%d' % (start, end - 1, f.size))
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', end - start)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', f.etag)
+        self.send_header('Last-Modified', self.date_time_string(f.mtime))
+        for header in headers:
+            self.send_header(header[0], header[1])
+        self.end_headers()
+
+        if body and end > start:
+            try:
+                self.send_file_range(f, start, end - start)
+            except:
+                self.close_connection = 1
+                raise
+            self.bytes_out = end - start
+
+    def not_modified(self, etag, mtime):
+        """
+        True if the request's If-None-Match/If-Modified-Since say the
+        client's copy is current. mtime may be None if there isn't one.
+        Tags that compress() marked with the coding match too.
+        """
+        tags = self.headers.get('If-None-Match')
+        if tags is not None:
+            for tag in tags.split(','):
+                tag = tag.strip()
+                if tag.startswith('W/'):
+                    tag = tag[2:]
+                for coding in ('-gzip"', '-deflate"'):
+                    if tag.endswith(coding):
+                        tag = tag[:-len(coding)] + '"'
+                if tag == '*' or tag == etag:
+                    return True
+            return False
+        since = self.headers.get('If-Modified-Since')
+        if since and mtime is not None:
+            since = email.utils.parsedate_tz(since)
+            if since is not None:
+                return int(mtime) <= email.utils.mktime_tz(since)
+        return False
+
+    def byte_range(self, size, etag, mtime):
+        """
+        Looks at the Range header. Returns None to send the whole file,
+        (start, end) for the part from start up to but not including end,
+        or False if the range can't be satisfied. Anything but a single
+        byte range (and a range with a stale If-Range) gets the whole file,
+        as does an invalid one like bytes=10-5, which RFC 7233 says to
+        ignore.
+        """
+        spec = self.headers.get('Range')
+        if not spec:
+            return None
+        if_range = self.headers.get('If-Range')
+        if if_range and if_range.strip() != etag and \
+           if_range.strip() != self.date_time_string(mtime):
+            return None
+        units, equals, spec = spec.partition('=')
+        if units.strip().lower() != 'bytes' or ',' in spec:
+            return None
+        first, dash, last = spec.strip().partition('-')
+        try:
+            if not first:
+                start = max(size - int(last), 0)
+                end = size
+            else:
+                start = int(first)
+                if last and int(last) < start:
+                    return None
+                end = last and min(int(last) + 1, size) or size
+        except ValueError:
+            return None
+        if start >= size or end <= start:
+            return False
+        return (start, end)
+
+    def send_file_range(self, f, offset, count):
+        if sendfile is not None and hasattr(self.connection, 'fileno'):
+            self.wfile.flush()
+            out = self.connection.fileno()
+            while count > 0:
+                try:
+                    sent = sendfile(out, f.fd, offset, min(count, 1 << 30))
+                except OSError, e:
+                    if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        raise
+                    # With a timeout set the socket is non-blocking
+                    # underneath, so wait until it can take more, as
+                    # long as sendall() on the same socket would (that's
+                    # the write_timeout once the response has started).
+                    timeout = self.connection.gettimeout()
+                    if not select.select([], [out], [], timeout)[1]:
+                        raise socket.timeout('timed out sending file')
+                    continue
+                if sent == 0:
+                    raise IOError(errno.EIO, 'file shrank while being sent')
+                offset += sent
+                count -= sent
+            return
+
+        m = f.map()
+        while count > 0:
+            n = min(count, self.stream_bufsize)
+            self.wfile.write(m[offset:offset + n])
+            offset += n
+            count -= n
+
+
+class WorkerPool:
+    """
+    A fixed set of daemon threads running whatever gets submit()ted to
+    them, in order, from one shared queue.
+    """
+
+    def __init__(self, workers=8, queue_size=0):
+        self.jobs = Queue.Queue(queue_size)
+        self.threads = []
+        for i in range(workers):
+            t = threading.Thread(target=self.run)
+            t.setDaemon(True)
+            t.start()
+            self.threads.append(t)
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            function, args = job
+            try:
+                function(*args)
+            except:
+                DebugMessage('WorkerPool job failed:\n' +
+                             traceback.format_exc(), 'ERROR')
+
+    def submit(self, function, *args):
+        self.jobs.put((function, args))
+
+    def offer(self, function, *args):
+        """Like submit(), but returns False instead of waiting for room."""
+        try:
+            self.jobs.put_nowait((function, args))
+        except Queue.Full:
+            return False
+        return True
+
+    def stop(self, timeout=None):
+        """
+        Tells the threads to quit after the jobs already submitted. With
+        a timeout, waits up to that many seconds for them to get there.
+        """
+        for t in self.threads:
+            self.jobs.put(None)
+        if timeout is not None:
+            deadline = time.time() + timeout
+            for t in self.threads:
+                t.join(max(deadline - time.time(), 0))
+
+
+class Trigger(asyncore.file_dispatcher):
+    """
+    Lets other threads hand work to the asyncore loop: call() queues a
+    function and writes a byte to a pipe the loop is watching, and the
+    loop runs the queued functions when it wakes up. There's no lock
+    involved (deque appends and pops are atomic), so call() is safe in
+    a signal handler too.
+    """
+
+    def __init__(self, map):
+        r, self.wfd = os.pipe()
+        asyncore.file_dispatcher.__init__(self, r, map)
+        self.calls = collections.deque()
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        try:
+            self.recv(8192)
+        except (OSError, socket.error):
+            pass
+        while self.calls:
+            self.calls.popleft()()
+
+    def call(self, function):
+        self.calls.append(function)
+        try:
+            os.write(self.wfd, 'x')
+        except OSError:
+            pass
+
+
+class ChannelRequest:
+    """
+    Stands in for the socket that MyHTTPRequestHandler expects: the
+    request comes from a string the channel already read, and whatever
+    the handler writes is passed back to the channel.
+    """
+
+    def __init__(self, channel, data):
+        self.channel = channel
+        self.data = data
+
+    def makefile(self, mode='r', bufsize=-1):
+        if 'w' in mode:
+            return ChannelWriter(self.channel)
+        return StringIO.StringIO(self.data)
+
+    def recv(self, size):
+        """For the lean parser's SocketReader."""
+        data = self.data[:size]
+        self.data = self.data[size:]
+        return data
+
+    def sendall(self, data):
+        """For the SocketWriter."""
+        if data:
+            self.channel.send_from_thread(str(data))
+
+    def settimeout(self, timeout):
+        pass
+
+
+class ChannelWriter:
+    """The wfile of a ChannelRequest."""
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.closed = False
+
+    def write(self, data):
+        if data:
+            self.channel.send_from_thread(str(data))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class SingleRequestHandler(MyHTTPRequestHandler):
+    """
+    MyHTTPRequestHandler for 'single' mode, where there's nobody else
+    to serve the other clients while one connection sits idle waiting
+    for its next request, so every connection is closed after one.
+    """
+    max_requests = 1
+
+
+class AsyncRequestHandler(MyHTTPRequestHandler):
+    """
+    MyHTTPRequestHandler run on one already buffered request. Afterwards
+    close_connection tells the channel whether to keep going.
+    """
+    # the channels are in the server's map, no need to track them twice
+    connections = None
+    # and the channel's socket is the one to set TCP_NODELAY on
+    disable_nagle_algorithm = False
+
+    def setup(self):
+        MyHTTPRequestHandler.setup(self)
+        self.requests_handled = self.request.channel.requests
+
+    def handle(self):
+        self.close_connection = 1
+        self.handle_one_request()
+
+
+class AsyncHTTPChannel(asynchat.async_chat):
+    """
+    One client connection in the asyncore server. Reads whole requests
+    (head plus a Content-Length body) without tying up a thread, runs
+    each one on the server's WorkerPool, and streams the reply back.
+    Requests on the same connection are run one at a time, in order;
+    while one is running the channel stops reading.
+
+    A handler that writes faster than the client reads is held up once
+    max_pending bytes are waiting to go out.
+
+    A request that finds the WorkerPool's queue full is answered with a
+    503 right away, and the connection closed. So is a head that runs
+    past max_head bytes, however many pieces it arrives in, with a 413.
+
+    The whole body is held in memory until it's all in, so there's
+    always a limit on it: MyHTTPRequestHandler.max_body if that's set,
+    and max_body here if not. Bigger bodies get a 413.
+    """
+    max_head = 65536
+    max_body = 16 * 1048576
+    max_pending = 262144
+    ac_in_buffer_size = 65536
+    ac_out_buffer_size = 65536
+
+    def __init__(self, server, sock, addr):
+        asynchat.async_chat.__init__(self, sock, map=server.map)
+        if MyHTTPRequestHandler.disable_nagle_algorithm:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.server = server
+        self.addr = addr
+        self.incoming = []
+        self.head_size = 0
+        self.head = None
+        self.waiting = collections.deque()
+        self.busy = False
+        self.requests = 0
+        self.pending = 0
+        self.space = threading.Condition()
+        self.last_active = time.time()
+        self.reading_since = None
+        self.set_terminator('\r\n\r\n')
+        self.counted = True
+        server.open += 1
+
+    def readable(self):
+        return not self.busy and not self.waiting and \
+            asynchat.async_chat.readable(self)
+
+    def idle(self):
+        """True between requests, with nothing left to send."""
+        return not self.busy and not self.waiting and not self.incoming \
+            and self.head is None and not self.writable()
+
+    def collect_incoming_data(self, data):
+        if self.get_terminator() is None:
+            # rejected, and all that's left is to close
+            return
+        if self.reading_since is None:
+            self.reading_since = time.time()
+        self.incoming.append(data)
+        if self.head is None:
+            self.head_size += len(data)
+            if self.head_size > self.max_head:
+                self.reject(httplib.REQUEST_ENTITY_TOO_LARGE)
+
+    def found_terminator(self):
+        self.last_active = time.time()
+        data = ''.join(self.incoming)
+        self.incoming = []
+        self.head_size = 0
+
+        if self.head is not None:
+            self.waiting.append(self.head + data)
+            self.head = None
+            self.reading_since = None
+            self.set_terminator('\r\n\r\n')
+            self.start_next()
+            return
+
+        head = data.lstrip('\r\n')
+        if not head:
+            # blank lines between requests are allowed, and mean nothing
+            return
+        head += '\r\n\r\n'
+        size = 0
+        expect = False
+        lines = head.split('\r\n')
+        for i in range(1, len(lines)):
+            name, colon, value = lines[i].partition(':')
+            name = name.strip().lower()
+            if name == 'content-length':
+                try:
+                    size = int(value)
+                except ValueError:
+                    return self.reject(httplib.BAD_REQUEST)
+            elif name == 'transfer-encoding':
+                return self.reject(httplib.LENGTH_REQUIRED)
+            elif name == 'expect' and value.strip().lower() == '100-continue':
+                expect = True
+                lines[i] = ''
+        head = '\r\n'.join([line for line in lines if line]) + '\r\n\r\n'
+
+        max_body = MyHTTPRequestHandler.max_body or self.max_body
+        if size > max_body:
+            return self.reject(httplib.REQUEST_ENTITY_TOO_LARGE)
+        if size > 0:
+            if expect:
+                # Answer it here, since the body has to arrive before the
+                # handler ever sees the request.
+                self.push('HTTP/1.1 100 Continue\r\n\r\n')
+            self.head = head
+            self.set_terminator(size)
+        else:
+            self.reading_since = None
+            self.waiting.append(head)
+            self.start_next()
+
+    def reject(self, code, response=None):
+        self.push(response or 'HTTP/1.1 %d %s\r\nContent-Length: 0\r\n'
+                  'Connection: close\r\n\r\n' %
+                  (code, httplib.responses[code]))
+        self.close_when_done()
+        self.incoming = []
+        self.head_size = 0
+        self.waiting.clear()
+        self.set_terminator(None)
+
+    def start_next(self):
+        if self.busy or not self.waiting:
+            return
+        if not self.server.executor.offer(self.run_request,
+                                          self.waiting[0]):
+            self.server.count('microhttpd_rejected_total', reason='queue')
+            self.reject(httplib.SERVICE_UNAVAILABLE,
+                        overloaded(MyHTTPRequestHandler.retry_after))
+            return
+        self.waiting.popleft()
+        self.busy = True
+
+    def run_request(self, data):
+        """Runs on a worker thread."""
+        close = 1
+        try:
+            handler = AsyncRequestHandler(ChannelRequest(self, data),
+                                          self.addr, self.server)
+            close = handler.close_connection
+            self.server.trigger.call(
+                lambda: self.request_done(close, handler.requests_handled))
+        except:
+            self.server.trigger.call(lambda: self.request_done(1, 0))
+            raise
+
+    def request_done(self, close, requests):
+        self.busy = False
+        self.requests = requests
+        self.last_active = time.time()
+        if close:
+            self.close_when_done()
+        else:
+            self.start_next()
+
+    def send_from_thread(self, data):
+        with self.space:
+            while self.pending > self.max_pending and self.connected:
+                self.space.wait(1.0)
+            if not self.connected:
+                raise socket.error(errno.EPIPE, 'client went away')
+            self.pending += len(data)
+        self.server.trigger.call(lambda: self.push(data))
+
+    def send(self, data):
+        sent = asynchat.async_chat.send(self, data)
+        if sent:
+            self.last_active = time.time()
+            with self.space:
+                self.pending -= sent
+                self.space.notify()
+        return sent
+
+    def handle_close(self):
+        self.close()
+        with self.space:
+            self.space.notifyAll()
+
+    def close(self):
+        if self.counted:
+            self.counted = False
+            self.server.open -= 1
+        asynchat.async_chat.close(self)
+
+
+class AsyncHTTPServer(asyncore.dispatcher):
+    """
+    Event loop server: one thread watches every connection with poll(),
+    so idle keep-alive and long-poll clients cost a socket and a little
+    memory rather than a thread each. Bound functions still run as
+    ordinary blocking calls, on a WorkerPool of 'workers' threads, with
+    up to 'queue_size' requests (0 for no limit) waiting for them.
+
+    Limits on slow and surplus clients work as they do for the other
+    modes (see Server.limits), except that they are checked every
+    poll_interval by sweep(), and without the 408.
+    """
+    request_queue_size = 1024
+    max_connections = None
+    metrics = None
+
+    def __init__(self, server_address, workers=8, sock=None, queue_size=0,
+                 backlog=None):
+        if backlog is not None:
+            self.request_queue_size = backlog
+        self.open = 0
+        self.next_sweep = 0
+        self.map = {}
+        asyncore.dispatcher.__init__(self, map=self.map)
+        if sock is None:
+            self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.set_reuse_addr()
+            self.bind(server_address)
+        else:
+            # already bound and listening, handed down by a hot restart
+            sock.setblocking(0)
+            self.set_socket(sock)
+        self.listen(self.request_queue_size)
+        self.trigger = Trigger(self.map)
+        self.executor = WorkerPool(workers, queue_size)
+        self.deadline = None
+
+    def handle_accept(self):
+        try:
+            pair = self.accept()
+        except socket.error:
+            return
+        if pair is None:
+            return
+        if self.max_connections and self.open >= self.max_connections:
+            sock = pair[0]
+            try:
+                sock.setblocking(0)
+                sock.send(overloaded(MyHTTPRequestHandler.retry_after))
+                sock.recv(65536)
+            except socket.error:
+                pass
+            sock.close()
+            self.count('microhttpd_rejected_total', reason='connections')
+            return
+        AsyncHTTPChannel(self, pair[0], pair[1])
+
+    def count(self, name, **labels):
+        if self.metrics is not None:
+            self.metrics.count(name, **labels)
+
+    def sweep(self):
+        """
+        Drops connections that sat idle past the keep-alive timeout, took
+        longer than read_timeout to send a request, or let a response sit
+        unread for write_timeout.
+        """
+        now = time.time()
+        # loop() comes back after every event, so don't do this every time
+        if now < self.next_sweep:
+            return
+        self.next_sweep = now + 0.5
+        timeout = MyHTTPRequestHandler.timeout
+        read_timeout = MyHTTPRequestHandler.read_timeout
+        write_timeout = MyHTTPRequestHandler.write_timeout
+        for channel in self.map.values():
+            if not isinstance(channel, AsyncHTTPChannel):
+                continue
+            if read_timeout and channel.reading_since is not None and \
+               channel.reading_since < now - read_timeout:
+                kind = 'read'
+            elif write_timeout and channel.writable() and \
+                    channel.last_active < now - write_timeout:
+                kind = 'write'
+            elif timeout and not channel.busy and not channel.writable() \
+                    and channel.last_active < now - timeout:
+                kind = 'idle'
+            else:
+                continue
+            self.count('microhttpd_timeouts_total', kind=kind)
+            channel.handle_close()
+
+    def serve_forever(self, poll_interval=1.0):
+        try:
+            while not self.drained():
+                asyncore.loop(self.deadline is None and poll_interval or 0.05,
+                              True, self.map, 1)
+                self.sweep()
+        finally:
+            for channel in self.map.values():
+                if isinstance(channel, AsyncHTTPChannel):
+                    channel.close()
+            if self.deadline is None:
+                self.executor.stop()
+            else:
+                self.executor.stop(max(self.deadline - time.time(), 0.1))
+
+    def shutdown(self, deadline=None):
+        """
+        Stops accepting connections. serve_forever() returns once the
+        ones already open have answered the request they are on, or at
+        deadline (a time.time()), whichever is first.
+        """
+        def stop():
+            if self.deadline is None:
+                self.deadline = deadline or time.time()
+                self.close()
+        self.trigger.call(stop)
+
+    def drained(self):
+        if self.deadline is None:
+            return False
+        left = 0
+        for channel in self.map.values():
+            if isinstance(channel, AsyncHTTPChannel):
+                if channel.idle():
+                    channel.handle_close()
+                else:
+                    left += 1
+        return not left or time.time() >= self.deadline
 
 
 class Server:
     def __init__(self):
         self.dispatch = Dispatch()
         MyHTTPRequestHandler.dispatch = self.dispatch
+        self.metrics = Metrics()
+        MyHTTPRequestHandler.metrics = self.metrics
+        self.dispatch.metrics = self.metrics
+        self.event_streams()
+        self.profiler = Profiler()
+        MyHTTPRequestHandler.profiler = self.profiler
+        self.connections = ConnectionTracker()
+        MyHTTPRequestHandler.connections = self.connections
+        MyHTTPRequestHandler.draining = False
+        self.httpd = None
+        self.children = None
+        self.deadline = None
 
         # 1.1 requires sending 'Content-Length'
         # 1.0 does not, but it doesn't hurt
         MyHTTPRequestHandler.protocol_version = "HTTP/1.1"
         self.ip_and_port()
+        self.concurrency()
+        self.keep_alive()
+        self.limits()
+        self.graceful()
 
     def ip_and_port(self, ip='127.0.0.1', port=8000):
         self.server_address = (ip, port)
 
+    def keep_alive(self, max_requests=100, timeout=15):
+        """
+        Limits for persistent connections: at most 'max_requests'
+        requests per connection (0 for no limit), and 'timeout' seconds
+        of idle time between requests before the connection is dropped.
+
+        In 'thread' and 'fork' modes an idle connection holds on to its
+        worker thread until it times out, so keep the timeout short when
+        there are many more clients than workers. 'single' mode has only
+        the one thread, so there every connection is closed after its
+        first request whatever these say (see SingleRequestHandler).
+        """
+        MyHTTPRequestHandler.max_requests = max_requests
+        MyHTTPRequestHandler.timeout = timeout
+
+    def profiling(self, rate=0.01, mode='cprofile', interval=0.005):
+        """
+        Profiles the given fraction of calls to each binding; see
+        Profiler. rate=0 stops profiling. Whatever was collected so far
+        is thrown away. The rates can also be changed later through
+        Profiler.handler, without a restart.
+        """
+        self.profiler = Profiler(rate, mode, interval)
+        MyHTTPRequestHandler.profiler = self.profiler
+
+    def access_log(self, target=None, format='common', flush_size=65536,
+                   interval=1.0):
+        """
+        Writes an access log record for every request to target, which
+        is a file name, an open file, or '-' for stdout; see AccessLog.
+        Once it is on, the per-request lines BaseHTTPServer writes to
+        stderr stop. target=None turns it off again.
+        """
+        if target is None:
+            if MyHTTPRequestHandler.access_log is not None:
+                MyHTTPRequestHandler.access_log.flush()
+            MyHTTPRequestHandler.access_log = None
+            return
+        if target == '-':
+            target = sys.stdout
+        elif isinstance(target, basestring):
+            target = open(target, 'a')
+        MyHTTPRequestHandler.access_log = AccessLog(target, format,
+                                                    flush_size, interval)
+
+    def compression(self, level=6, min_size=1024, cache_size=0,
+                    static_gz=True):
+        """
+        Turns on gzip/deflate compression of responses; see Compression
+        for what the arguments mean. level=0 turns it off again.
+        """
+        if level:
+            MyHTTPRequestHandler.compression = Compression(
+                level, min_size, cache_size, static_gz)
+        else:
+            MyHTTPRequestHandler.compression = None
+
+    def body_limit(self, max_body=None):
+        """
+        Refuse request bodies of more than max_body bytes (None for no
+        limit). 'async' mode reads bodies into memory, so there None
+        means AsyncHTTPChannel.max_body, 16MB.
+        """
+        MyHTTPRequestHandler.max_body = max_body
+
+    def event_streams(self, max_pending=100, heartbeat=15, retry=3):
+        """
+        Settings for event streams (see EventHub). Anyone subscribed so
+        far stays with the old settings, and stops getting what's
+        published.
+        """
+        self.events = EventHub(max_pending, heartbeat, retry)
+        self.events.metrics = self.metrics
+        self.metrics.gauge('microhttpd_subscribers', self.events.count)
+
+    def publish(self, channel, data, event=None, id=None):
+        """
+        Sends an event to the clients subscribed to channel, e.g. with
+
+          server.dispatch.bind('/events', server.events.handler)
+
+        and returns how many of them there are. See EventHub.
+        """
+        return self.events.publish(channel, data, event, id)
+
+    def batch(self, url='/batch', workers=8, max_requests=50,
+              max_body=1048576, max_bytes=4 * 1048576):
+        """
+        Binds url to take batches of requests in one POST; see Batch
+        for the format and what the arguments mean. Returns the Batch.
+        """
+        batch = Batch(self.dispatch, workers, max_requests, max_body,
+                      max_bytes)
+        self.dispatch.bind(url, batch.handler, stream=True)
+        return batch
+
+    def lean_parser(self, on=True, max_head=65536):
+        """
+        Parse requests with the lean parser instead of BaseHTTPServer's
+        (see MyHTTPRequestHandler), which matters when requests are small
+        and the bound functions are quick. max_head limits the size of
+        a request head.
+        """
+        MyHTTPRequestHandler.lean = on
+        MyHTTPRequestHandler.max_head = max_head
+
+    def limits(self, max_connections=None, backlog=1024, read_timeout=None,
+               write_timeout=None, shed=True, retry_after=1):
+        """
+        Protection against overload and slow clients.
+
+          max_connections  connections open at once (being served or
+                           waiting for a worker); past that, new ones get
+                           a 503 without their request being read. None
+                           for no limit. Per process in 'fork' mode.
+          backlog          connections the kernel holds for us before we
+                           accept them (the listen() backlog)
+          read_timeout     seconds a client gets to send a whole request,
+                           from its first byte, however slowly it
+                           trickles in (the keep-alive timeout covers the
+                           wait for that byte). None for no limit.
+          write_timeout    seconds a response may sit with the client not
+                           reading any of it. None means the keep-alive
+                           timeout.
+          shed             in 'thread', 'fork' and 'async' modes, answer
+                           with a 503 when the queue of concurrency()'s
+                           queue_size is full, instead of waiting for a
+                           worker (in 'async' mode the queue holds
+                           requests rather than connections)
+          retry_after      the Retry-After sent with those 503s
+
+        Rejections and timeouts are counted in the metrics, as are the
+        open connections and the queue depth.
+        """
+        self.max_connections = max_connections
+        self.backlog = backlog
+        self.shed = shed
+        MyHTTPRequestHandler.read_timeout = read_timeout
+        MyHTTPRequestHandler.write_timeout = write_timeout
+        MyHTTPRequestHandler.retry_after = retry_after
+
+    def graceful(self, timeout=10, stop_signal=signal.SIGTERM,
+                 restart_signal=signal.SIGHUP, restart_timeout=30):
+        """
+        How the server stops and restarts. stop_signal calls shutdown(),
+        which gives requests in progress up to 'timeout' seconds to be
+        answered. restart_signal calls restart(), which gives the new
+        process up to 'restart_timeout' seconds to start serving. Pass
+        None for either signal to leave it alone. The handlers are set
+        up by serve_forever(), which has to run in the main thread for
+        that.
+        """
+        self.drain_timeout = timeout
+        self.stop_signal = stop_signal
+        self.restart_signal = restart_signal
+        self.restart_timeout = restart_timeout
+
+    def concurrency(self, mode='single', workers=8, queue_size=64,
+                    processes=None):
+        """
+        Picks how requests get served.
+
+          'single'  one request at a time, in the thread that called
+                    serve_forever(), and one per connection: no
+                    keep-alive, see keep_alive()
+          'thread'  a pool of 'workers' threads fed from a queue of at
+                    most 'queue_size' waiting connections
+          'fork'    'processes' pre-forked worker processes (default:
+                    one per CPU) all accepting on the same inherited
+                    listening socket, each running its own thread pool
+                    as in 'thread' mode
+          'async'   a single asyncore event loop holding all the
+                    connections, with bound functions run on a pool of
+                    'workers' threads; good for lots of mostly idle
+                    keep-alive or long-poll clients
+
+        Event streams (see EventHub) can't be served in 'single' mode,
+        where one subscriber would hold up everyone else; they get a 503.
+
+        In 'fork' mode each worker gets a copy of the bindings as they
+        were when serve_forever() was called, so do all your bind()
+        calls before that.
+        """
+        if mode not in ('single', 'thread', 'fork', 'async'):
+            raise ValueError('unknown concurrency mode: %r' % mode)
+        if processes is None:
+            try:
+                processes = multiprocessing.cpu_count()
+            except NotImplementedError:
+                processes = 1
+        self.mode = mode
+        self.workers = workers
+        self.queue_size = queue_size
+        self.processes = processes
+
+    def make_httpd(self):
+        sock = self.inherited_socket()
+        if self.mode == 'single':
+            return self.open_httpd(BaseHTTPServer.HTTPServer, sock,
+                                   SingleRequestHandler)
+        cache = self.dispatch.cache
+        if cache is not None and not isinstance(cache, LockedRouteCache):
+            self.dispatch.route_cache(cache.size, threadsafe=True)
+        if self.mode == 'async':
+            httpd = AsyncHTTPServer(self.server_address, self.workers, sock,
+                                    self.shed and self.queue_size or 0,
+                                    self.backlog)
+            httpd.max_connections = self.max_connections
+            httpd.metrics = self.metrics
+            self.metrics.gauge('microhttpd_connections', lambda: httpd.open)
+            self.metrics.gauge('microhttpd_queue_depth',
+                               httpd.executor.jobs.qsize)
+            return httpd
+        httpd = self.open_httpd(ThreadPoolHTTPServer, sock)
+        httpd.workers = self.workers
+        httpd.queue_size = self.queue_size
+        httpd.shed = self.shed
+        httpd.max_connections = self.max_connections
+        httpd.retry_after = MyHTTPRequestHandler.retry_after
+        httpd.connections = self.connections
+        httpd.metrics = self.metrics
+        self.metrics.gauge('microhttpd_queue_depth',
+                           lambda: httpd.pending.qsize())
+        return httpd
+
+    def open_httpd(self, cls, sock, handler=MyHTTPRequestHandler):
+        """A cls server listening on sock if there is one, else on server_address."""
+        httpd = cls(self.server_address, handler, False)
+        httpd.request_queue_size = self.backlog
+        self.metrics.gauge('microhttpd_connections', self.connections.count)
+        if sock is None:
+            try:
+                httpd.server_bind()
+                httpd.server_activate()
+            except:
+                httpd.server_close()
+                raise
+            return httpd
+        httpd.socket.close()
+        httpd.socket = sock
+        httpd.server_address = sock.getsockname()
+        httpd.server_name = socket.getfqdn(httpd.server_address[0])
+        httpd.server_port = httpd.server_address[1]
+        httpd.server_activate()
+        return httpd
+
+    def inherited_socket(self):
+        """The listening socket handed down by restart(), if any."""
+        fd = os.environ.pop('MICROHTTPD_FD', None)
+        if fd is None:
+            return None
+        # fromfd() gives a bare _socket.socket, whose accept()ed sockets
+        # close themselves as soon as they're garbage, fileobjects or not
+        sock = socket.socket(_sock=socket.fromfd(int(fd), socket.AF_INET,
+                                                 socket.SOCK_STREAM))
+        os.close(int(fd))
+        return sock
+
+    def tell_ready(self):
+        """Lets the process that started us with restart() know we're serving."""
+        fd = os.environ.pop('MICROHTTPD_READY', None)
+        if fd is not None:
+            try:
+                os.write(int(fd), 'x')
+                os.close(int(fd))
+            except OSError:
+                pass
+
+    def set_signals(self, stop, restart):
+        for signum, handler in ((self.stop_signal, stop),
+                                (self.restart_signal, restart)):
+            if signum is not None:
+                signal.signal(signum, handler)
+
     def serve_forever(self):
-        self.httpd = BaseHTTPServer.HTTPServer(self.server_address,
-                                               MyHTTPRequestHandler)
+        self.events.single = self.mode == 'single'
+        self.httpd = self.make_httpd()
         sa = self.httpd.socket.getsockname()
         print "Serving HTTP on", sa[0], "port", sa[1], "..."
-        self.httpd.serve_forever()
+        try:
+            self.set_signals(lambda signum, frame: self.shutdown(),
+                             lambda signum, frame: self.restart())
+        except ValueError:
+            # not the main thread; signals are up to whoever started us
+            pass
+        self.tell_ready()
+        if self.mode == 'fork':
+            self.serve_prefork()
+        else:
+            self.serve_httpd()
+
+    def serve_httpd(self):
+        self.dispatch.start_pools()
+        if self.mode == 'async':
+            self.httpd.serve_forever()
+            self.finish()
+            return
+        if self.mode != 'single':
+            self.httpd.start_workers()
+        if MyHTTPRequestHandler.read_timeout:
+            t = threading.Thread(target=self.expire_slow_clients)
+            t.setDaemon(True)
+            t.start()
+        try:
+            self.httpd.serve_forever()
+        except:
+            if self.mode != 'single':
+                self.httpd.stop_workers()
+            raise
+        deadline = self.deadline or time.time()
+        self.httpd.server_close()
+        left = self.connections.drain(deadline)
+        if self.mode != 'single':
+            self.httpd.stop_workers(max(deadline - time.time(), 0))
+        if left:
+            DebugMessage('shut down with %d connections still busy' % left,
+                         'WARNING')
+        self.finish()
+
+    def expire_slow_clients(self):
+        """Hangs up on clients that are past their read_timeout, until shutdown."""
+        interval = min(1.0, MyHTTPRequestHandler.read_timeout / 4.0)
+        while self.deadline is None:
+            time.sleep(interval)
+            late = self.connections.expire()
+            if late:
+                self.metrics.count('microhttpd_timeouts_total', late,
+                                   kind='read')
+
+    def finish(self):
+        self.dispatch.stop_pools(max((self.deadline or 0) - time.time(), 0))
+        if MyHTTPRequestHandler.access_log is not None:
+            MyHTTPRequestHandler.access_log.flush()
+
+    def shutdown(self, timeout=None):
+        """
+        Stops accepting connections, and makes serve_forever() return
+        once the requests in progress have been answered, or 'timeout'
+        seconds have passed (by default, the one given to graceful()),
+        whichever is first. Idle keep-alive connections are closed right
+        away, busy ones after their current response. In 'fork' mode the
+        workers are told to do the same, with their own timeout.
+
+        This only starts things off, and returns straight away, so it is
+        fine to call from a signal handler or a bound function.
+        """
+        if self.deadline is not None:
+            return
+        if timeout is None:
+            timeout = self.drain_timeout
+        self.deadline = time.time() + timeout
+        MyHTTPRequestHandler.draining = True
+        # event streams would otherwise go on until the deadline
+        self.events.close()
+        if self.httpd is None:
+            return
+        if self.children is not None:
+            for pid in self.children.keys():
+                try:
+                    os.kill(pid, self.stop_signal or signal.SIGTERM)
+                except OSError:
+                    pass
+        elif self.mode == 'async':
+            self.httpd.shutdown(self.deadline)
+        else:
+            def stop():
+                self.connections.hang_up()
+                self.httpd.shutdown()
+            t = threading.Thread(target=stop)
+            t.setDaemon(True)
+            t.start()
+
+    def restart(self):
+        """
+        Hot restart: starts a fresh copy of this program (the same
+        interpreter, arguments and working directory) that serves on our
+        listening socket, and once it says it is serving, shut down
+        gracefully. The socket stays open throughout, so connections
+        that arrive in between wait in its queue rather than being
+        refused. If the new process doesn't come up within the
+        restart_timeout given to graceful(), we just carry on.
+
+        The new process is a child of this one until we exit, so a
+        supervisor that watches our pid will think the server died.
+        Returns straight away; the waiting happens in another thread.
+        """
+        if self.httpd is None or self.deadline is not None:
+            return
+        t = threading.Thread(target=self.hand_over)
+        t.setDaemon(True)
+        t.start()
+
+    def hand_over(self):
+        fd = self.httpd.socket.fileno()
+        flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+        fcntl.fcntl(fd, fcntl.F_SETFD, flags & ~fcntl.FD_CLOEXEC)
+        r, w = os.pipe()
+        env = dict(os.environ)
+        env['MICROHTTPD_FD'] = str(fd)
+        env['MICROHTTPD_READY'] = str(w)
+        argv = [sys.executable] + sys.argv
+        try:
+            maxfd = os.sysconf('SC_OPEN_MAX')
+        except (AttributeError, ValueError):
+            maxfd = 1024
+        pid = os.fork()
+        if pid == 0:
+            try:
+                # Only the listening socket and the pipe go along; a
+                # client connection left open in the new process would
+                # never see its close from us.
+                low, high = min(fd, w), max(fd, w)
+                os.closerange(3, low)
+                os.closerange(low + 1, high)
+                os.closerange(high + 1, maxfd)
+                os.execve(sys.executable, argv, env)
+            finally:
+                os._exit(127)
+        os.close(w)
+        try:
+            ready = select.select([r], [], [], self.restart_timeout)[0] and \
+                os.read(r, 1)
+        finally:
+            os.close(r)
+        if ready:
+            DebugMessage('handed over to process %d' % pid, 'INFO')
+            self.shutdown()
+            return
+        DebugMessage('restart failed: process %d did not start serving' % pid,
+                     'ERROR')
+        try:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        except OSError:
+            pass
+
+    def serve_prefork(self):
+        """
+        Forks the worker processes and then just sits and waits on
+        them, replacing any that die. The listening socket was opened
+        before the fork, so the kernel spreads incoming connections
+        over the workers.
+        """
+        self.children = {}
+        overdue = False
+        try:
+            while True:
+                while self.deadline is None and \
+                        len(self.children) < self.processes:
+                    pid = os.fork()
+                    if pid == 0:
+                        self.children = None
+                        try:
+                            # restarts are the parent's business
+                            self.set_signals(
+                                lambda signum, frame: self.shutdown(),
+                                signal.SIG_IGN)
+                            self.serve_httpd()
+                        finally:
+                            os._exit(0)
+                    self.children[pid] = True
+                if self.deadline is not None:
+                    if not self.children:
+                        break
+                    # give the workers a moment past their own deadline
+                    if time.time() > self.deadline + 1:
+                        overdue = True
+                        break
+                    time.sleep(0.05)
+                try:
+                    pid, status = os.waitpid(
+                        -1, self.deadline is not None and os.WNOHANG or 0)
+                except OSError, e:
+                    if e.errno in (errno.EINTR, errno.ECHILD):
+                        continue
+                    raise
+                if pid == 0:
+                    continue
+                if DEBUG_HTTP.on:
+                    print "worker %d exited with status %d" % (pid, status)
+                self.children.pop(pid, None)
+        finally:
+            for pid in self.children.keys():
+                try:
+                    os.kill(pid, overdue and signal.SIGKILL or signal.SIGTERM)
+                except OSError:
+                    pass
+            self.finish()
 
 
 if __name__ == '__main__':
@@ -418,6 +4710,43 @@ if __name__ == '__main__':
         default=False,
         help=
         "Stop printing HTTP traffic to stderr - DANGER, this just kills stderr...")
+    parser.add_option("-l", "--log",
+                      action="store",
+                      type="string",
+                      dest="log",
+                      default=None,
+                      help="Write an access log to this file ('-' for stdout)")
+    parser.add_option("--log-format",
+                      action="store",
+                      type="choice",
+                      choices=['common', 'json'],
+                      dest="log_format",
+                      default="common",
+                      help="Access log format: common or json. Default is common")
+    parser.add_option("-m", "--mode",
+                      action="store",
+                      type="choice",
+                      choices=['single', 'thread', 'fork', 'async'],
+                      dest="mode",
+                      default="single",
+                      help="Concurrency mode: single, thread, fork or async. Default is single")
+    parser.add_option("-w", "--workers",
+                      action="store",
+                      type="int",
+                      dest="workers",
+                      default=8,
+                      help="Worker threads (per process) in thread, fork and async modes. Default is 8")
+    parser.add_option("-P", "--processes",
+                      action="store",
+                      type="int",
+                      dest="processes",
+                      default=None,
+                      help="Worker processes in fork mode. Default is one per CPU")
+    parser.add_option("--lean",
+                      action="store_true",
+                      dest="lean",
+                      default=False,
+                      help="Parse requests with the lean parser")
     server = Server()
 
     argv = sys.argv
@@ -443,11 +4772,21 @@ if __name__ == '__main__':
     print 'port:', opts.port, 'ip:', opts.ip
 
     server.ip_and_port(opts.ip, opts.port)
+    server.concurrency(opts.mode, workers=opts.workers,
+                       processes=opts.processes)
+    server.lean_parser(opts.lean)
+    if opts.log:
+        server.access_log(opts.log, opts.log_format)
 
     server.dispatch.set_baseurl("http://localhost/tester")
+    server.dispatch.route_cache(1024)
 
-    server.dispatch.bind('/version', echo, __version__)
+    server.dispatch.bind('/version', constant, Response(
+        __version__ + "\n", [('Content-type', "text/plain")], frozen=True))
     server.dispatch.bind('/urltest', urltest)
+    server.dispatch.bind('/metrics', server.metrics.handler)
+    server.batch('/batch')
+    server.dispatch.bind('/events', server.events.handler)
     server.dispatch.bind('/exit', exit)
     server.dispatch.bind('/', echo, "index")
     server.dispatch.bind('/foo', echo, "index")
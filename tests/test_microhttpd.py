@@ -0,0 +1,304 @@
+import gzip
+import httplib
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from StringIO import StringIO
+
+from adpytools import microhttpd
+from adpytools.microhttpd import Dispatch, Response, Server
+
+
+class DispatchTest(unittest.TestCase):
+
+    def test_invoke_uses_table_from_lookup(self):
+        dispatch = Dispatch()
+        dispatch.bind('/a', lambda **kw: {'r': 'old'})
+        found = dispatch.lookup('/a')
+        dispatch.bind('/a', lambda **kw: {'r': 'new'})
+        self.assertEqual(dispatch.invoke(found, 'GET', None)['r'], 'old')
+        dispatch.unbind('/a')
+        self.assertEqual(dispatch.invoke(found, 'GET', None)['r'], 'old')
+        self.assertEqual(dispatch.call('/a', 'GET', None)['c'], 404)
+
+    def test_rebind_during_cached_call(self):
+        dispatch = Dispatch()
+        started = threading.Event()
+        go = threading.Event()
+
+        def old(**kw):
+            started.set()
+            go.wait(5)
+            return {'r': 'old'}
+        dispatch.bind('/a', old, cache_ttl=60)
+        t = threading.Thread(target=dispatch.call, args=('/a', 'GET', None))
+        t.start()
+        started.wait(5)
+        dispatch.bind('/a', lambda **kw: {'r': 'new'}, cache_ttl=60)
+        go.set()
+        t.join(5)
+        self.assertEqual(dispatch.call('/a', 'GET', None)['r'], 'new')
+
+
+def square(type, match, ext, rest, note):
+    return {'r': str(int(rest.strip('/')) ** 2)}
+
+
+class ProcessPoolRebindTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dispatch = Dispatch()
+        self.dispatch.pool('cpu', 'process', workers=1, timeout=5)
+        self.dispatch.bind('/square', square, pool='cpu')
+
+    def tearDown(self):
+        self.dispatch.stop_pools(5)
+
+    def test_unrelated_bind_keeps_workers(self):
+        self.assertEqual(self.dispatch.call('/square/3', 'GET', None)['r'],
+                         '9')
+        workers = self.dispatch.pools['cpu'].pool
+        for i in range(20):
+            self.dispatch.bind('/other%d' % i, square)
+        self.dispatch.unbind('/other0')
+        self.assertEqual(self.dispatch.call('/square/4', 'GET', None)['r'],
+                         '16')
+        self.assertTrue(self.dispatch.pools['cpu'].pool is workers)
+
+    def test_pool_binding_restarts_workers(self):
+        self.dispatch.call('/square/3', 'GET', None)
+        workers = self.dispatch.pools['cpu'].pool
+        self.dispatch.bind('/cube', square, pool='cpu')
+        self.assertEqual(self.dispatch.call('/cube/5', 'GET', None)['r'],
+                         '25')
+        self.assertTrue(self.dispatch.pools['cpu'].pool is not workers)
+
+
+class ServerTestCase(unittest.TestCase):
+    """Runs a Server in thread mode on a free port for the test's duration."""
+    mode = 'thread'
+
+    def setUp(self):
+        self.server = Server()
+        self.server.ip_and_port('127.0.0.1', 0)
+        self.server.concurrency(self.mode, workers=2)
+        self.bind()
+        t = threading.Thread(target=self.server.serve_forever)
+        t.setDaemon(True)
+        t.start()
+        self.thread = t
+        while self.server.httpd is None:
+            time.sleep(0.01)
+        self.port = self.server.httpd.socket.getsockname()[1]
+
+    def tearDown(self):
+        self.server.shutdown(1)
+        self.thread.join(5)
+        microhttpd.MyHTTPRequestHandler.compression = None
+
+    def bind(self):
+        pass
+
+    def get(self, path, headers={}):
+        return self.request('GET', path, None, headers)
+
+    def request(self, method, path, body=None, headers={}):
+        conn = httplib.HTTPConnection('127.0.0.1', self.port, timeout=5)
+        conn.request(method, path, body, headers)
+        r = conn.getresponse()
+        return r, r.read()
+
+
+class CompressedFileTest(ServerTestCase):
+    data = 'microhttpd compressed file body\n' * 1000
+
+    def bind(self):
+        fd, self.path = tempfile.mkstemp()
+        os.write(fd, self.data)
+        os.close(fd)
+        self.opened = []
+
+        def handler(type, match, ext, rest, note):
+            f = open(self.path, 'rb')
+            self.opened.append(f)
+            return Response(f, [('Content-type', 'text/plain')])
+        self.server.dispatch.bind('/file', handler)
+        self.server.compression(min_size=1)
+
+    def tearDown(self):
+        ServerTestCase.tearDown(self)
+        os.unlink(self.path)
+
+    def test_gzip_file_body(self):
+        r, body = self.get('/file', {'Accept-Encoding': 'gzip'})
+        self.assertEqual(r.status, 200)
+        self.assertEqual(r.getheader('Content-Encoding'), 'gzip')
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO(body)).read(),
+                         self.data)
+        self.assertTrue(self.opened[0].closed)
+
+
+class StaticTestCase(ServerTestCase):
+    """Serves static files out of a temporary directory."""
+    data = '0123456789' * 10
+
+    def bind(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        with open(os.path.join(self.dir, 'digits.txt'), 'w') as f:
+            f.write(self.data)
+        os.chdir(self.dir)
+
+    def tearDown(self):
+        ServerTestCase.tearDown(self)
+        os.chdir(self.cwd)
+        os.unlink(os.path.join(self.dir, 'digits.txt'))
+        os.rmdir(self.dir)
+
+
+def not_found(type, match, ext, rest, note):
+    return {'c': 404}
+
+
+class PoolFallbackTest(StaticTestCase):
+
+    def bind(self):
+        StaticTestCase.bind(self)
+        self.server.dispatch.pool('cpu', 'process', workers=1, timeout=5)
+        self.server.dispatch.bind('/digits', not_found, pool='cpu')
+
+    def test_pool_404_falls_back_to_file(self):
+        r, body = self.get('/digits.txt')
+        self.assertEqual(r.status, 200)
+        self.assertEqual(body, self.data)
+
+
+class RangeTest(StaticTestCase):
+
+    def test_directory_redirect_keeps_connection(self):
+        os.mkdir(os.path.join(self.dir, 'sub'))
+        try:
+            conn = httplib.HTTPConnection('127.0.0.1', self.port, timeout=2)
+            conn.request('GET', '/sub?x=1')
+            r = conn.getresponse()
+            self.assertEqual(r.status, 301)
+            self.assertEqual(r.getheader('Location'), '/sub/?x=1')
+            self.assertEqual(r.read(), '')
+            # the same connection carries on with the next request
+            conn.request('GET', '/digits.txt')
+            self.assertEqual(conn.getresponse().read(), self.data)
+        finally:
+            os.rmdir(os.path.join(self.dir, 'sub'))
+
+    def test_range(self):
+        r, body = self.get('/digits.txt', {'Range': 'bytes=10-14'})
+        self.assertEqual(r.status, 206)
+        self.assertEqual(body, '01234')
+
+    def test_invalid_range_is_ignored(self):
+        r, body = self.get('/digits.txt', {'Range': 'bytes=10-5'})
+        self.assertEqual(r.status, 200)
+        self.assertEqual(body, self.data)
+
+    def test_range_past_end(self):
+        r, body = self.get('/digits.txt', {'Range': 'bytes=500-'})
+        self.assertEqual(r.status, 416)
+
+
+class ProcessPoolTest(ServerTestCase):
+
+    def bind(self):
+        def die(type, match, ext, rest, note):
+            os._exit(1)
+        self.server.dispatch.pool('cpu', 'process', workers=1, max_pending=1,
+                                  timeout=0.5)
+        self.server.dispatch.bind('/die', die, pool='cpu')
+
+    def test_dead_worker_releases_slot(self):
+        # a lost slot would turn the second call into a 503
+        for i in range(2):
+            r, body = self.get('/die')
+            self.assertEqual(r.status, 504)
+
+    def test_timeout_required(self):
+        self.assertRaises(ValueError, self.server.dispatch.pool, 'x',
+                          'process')
+
+
+class EventStreamTest(ServerTestCase):
+
+    def bind(self):
+        events = self.server.events
+
+        def stream(type, match, ext, rest, note):
+            return events.stream(['news'])
+        self.server.dispatch.pool('cpu', 'process', workers=1, timeout=5)
+        self.server.dispatch.bind('/pooled', stream, pool='cpu')
+
+    def test_pooled_stream_refused(self):
+        r, body = self.get('/pooled')
+        self.assertEqual(r.status, 500)
+        # the worker is free for the next call
+        r, body = self.get('/pooled')
+        self.assertEqual(r.status, 500)
+
+
+class SingleModeEventStreamTest(ServerTestCase):
+    mode = 'single'
+
+    def bind(self):
+        self.server.dispatch.bind('/events', self.server.events.handler)
+
+    def test_subscribe_refused(self):
+        r, body = self.get('/events?channel=news')
+        self.assertEqual(r.status, 503)
+
+
+class BatchTest(ServerTestCase):
+
+    def bind(self):
+        self.closed = []
+
+        def pieces(n):
+            try:
+                for i in range(n):
+                    yield 'piece %d\n' % i
+            finally:
+                self.closed.append(n)
+
+        def handler(type, match, ext, rest, note):
+            return Response(pieces(int(rest.strip('/'))),
+                            [('Content-type', 'text/plain')])
+
+        def events(type, match, ext, rest, note):
+            return Response(pieces(1), [('Content-type', 'text/event-stream')])
+        self.server.dispatch.bind('/pieces', handler)
+        self.server.dispatch.bind('/events', events)
+        self.server.batch('/batch', workers=0, max_bytes=100)
+
+    def batch(self, *requests):
+        r, body = self.request('POST', '/batch', json.dumps(requests))
+        self.assertEqual(r.status, 200)
+        return json.loads(body)
+
+    def test_generator_body(self):
+        result, = self.batch(['GET', '/pieces/3'])
+        self.assertEqual(result['c'], 200)
+        self.assertEqual(result['r'], 'piece 0\npiece 1\npiece 2\n')
+        self.assertEqual(self.closed, [3])
+
+    def test_long_generator_body(self):
+        result, = self.batch(['GET', '/pieces/1000'])
+        self.assertEqual(result['c'], 507)
+        self.assertEqual(self.closed, [1000])
+
+    def test_event_stream(self):
+        result, = self.batch(['GET', '/events'])
+        self.assertEqual(result['c'], 400)
+
+
+if __name__ == '__main__':
+    unittest.main()